@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+#
+# Benchmark the protocol and decode hot paths of itho-wpu.py against an emulated WPU, with a
+# synthetic database. Results are written as JSON and can be compared with an earlier run.
+
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import db
+from itho_decode import datatypes, get_datalog_structure
+from itho_emulator import EmulatedWPU
+from itho_i2c import I2CMaster, actions, is_checksum_valid
+from itho_metadata import HeatpumpMetadata
+
+listversion = 11
+wpu_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "itho-wpu.py")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark python-itho-wpu")
+    parser.add_argument("--output", nargs="?", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", nargs="?", help="Compare with the results in this file")
+    parser.add_argument(
+        "--max-regression",
+        nargs="?",
+        type=float,
+        default=0.1,
+        help="Fail when a benchmark is this fraction slower than in --compare",
+    )
+    parser.add_argument(
+        "--filter", nargs="?", help="Only run benchmarks of which the name contains this"
+    )
+    parser.add_argument(
+        "--latency",
+        nargs="?",
+        type=float,
+        default=0.02,
+        help="Response time in seconds of the emulated WPU in the getsettings benchmarks",
+    )
+    parser.add_argument("--repeat", nargs="?", type=int, default=5, help="Runs per benchmark")
+    args = parser.parse_args()
+    return args
+
+
+def create_database(path, datalabels=120, settings=200, manuals=60, counters=30):
+    """
+    Create a heatpump.sqlite with one list version, sized like a real WPU.
+    """
+    d = db.sqlite(path)
+    for t in ["versiebeheer", "datalabel_v1", "parameterlijst_v1", "handbed_v1", "counters_v1"]:
+        d.create_table(t)
+    d.insert("versiebeheer", [(listversion, 1, 1, 1, 1)])
+    units = ["°C", "K", "%", "bar", None]
+    d.insert(
+        "datalabel_v1",
+        [(i, f"label_{i}", f"Label {i}", None, units[i % len(units)]) for i in range(datalabels)],
+    )
+    d.insert(
+        "parameterlijst_v1",
+        [
+            (
+                i,
+                f"setting_{i}",
+                f"setting_{i}",
+                -10 * (i % 2),
+                100.0 + i,
+                50,
+                f"Setting {i}",
+                "",
+                None,
+            )
+            for i in range(settings)
+        ],
+    )
+    d.insert(
+        "handbed_v1",
+        [
+            (i, f"manual_{i}", f"manual_{i}", 0, 100, 0, f"Manual {i}", "", None)
+            for i in range(manuals)
+        ],
+    )
+    d.insert(
+        "counters_v1",
+        [(i, f"counter_{i}", f"Counter {i}", None, "uur") for i in range(counters)],
+    )
+    d.conn.close()
+
+
+def load_wpu_module():
+    spec = importlib.util.spec_from_file_location("itho_wpu", wpu_script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(function, repeat, number=None):
+    """
+    Return the minimum and median time in seconds of one call of `function`.
+    """
+    timer = timeit.Timer(function)
+    if number is None:
+        number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {"min": min(times), "median": statistics.median(times), "runs": repeat * number}
+
+
+def get_benchmarks(args, wpu_module, wpu, metadata):
+    """
+    Return a dict of benchmark name: function without arguments that returns its results.
+    """
+    benchmarks = {}
+    repeat = args.repeat
+
+    for dt in sorted(datatypes):
+        benchmarks[f"format_datatype[0x{dt:02x}]"] = lambda dt=dt: measure(
+            lambda: wpu_module.format_datatype("label", b"\x01\x02\x03\x04", dt), repeat
+        )
+
+    master = I2CMaster.__new__(I2CMaster)
+    request = master.compose_request("getdatalog", None, None, None, True)
+    response = wpu.call("getdatalog")
+    benchmarks["calculate_checksum"] = lambda: measure(
+        lambda: master.calculate_checksum(request), repeat
+    )
+    benchmarks["is_checksum_valid[getdatalog]"] = lambda: measure(
+        lambda: is_checksum_valid(response), repeat
+    )
+    for action in actions:
+        value = 1 if action.startswith("set") else None
+        datatype = 0x10 if action == "setmanual" else None
+        benchmarks[f"compose_request[{action}]"] = lambda a=action, v=value, d=datatype: measure(
+            lambda: master.compose_request(a, 1, d, v, True), repeat
+        )
+
+    benchmarks["get_datalog_structure"] = lambda: measure(
+        lambda: get_datalog_structure(wpu.datatype, metadata.datalabels), repeat
+    )
+    benchmarks["process_datalog"] = lambda: measure(
+        lambda: wpu_module.process_datalog(response, wpu), repeat
+    )
+
+    class SettingsArgs:
+        pipeline_depth = 1
+        snapshot = None
+
+    def getsettings(depth):
+        SettingsArgs.pipeline_depth = depth
+        wpu.transport.delay = args.latency
+        wpu.open()
+        try:
+            return measure(lambda: wpu_module.process_settings(wpu, SettingsArgs), 3, 1)
+        finally:
+            wpu.close()
+            wpu.transport.delay = 0
+
+    benchmarks["getsettings[depth=1]"] = lambda: getsettings(1)
+    benchmarks["getsettings[depth=4]"] = lambda: getsettings(4)
+
+    def cold_start():
+        command = [sys.executable, wpu_script, "--action", "getnodeid", "--no-cache"]
+        command += ["--emulate", str(listversion), "--emulate-delay", "0"]
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - started)
+        return {"min": min(times), "median": statistics.median(times), "runs": repeat}
+
+    benchmarks["cold_start"] = cold_start
+    return benchmarks
+
+
+def compare(results, baseline, max_regression):
+    """
+    Print the change of the median of every benchmark. Returns False when a benchmark is more
+    than `max_regression` slower than in the baseline.
+    """
+    ok = True
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["median"] / baseline[name]["median"] - 1
+        regression = change > max_regression
+        ok = ok and not regression
+        print(
+            f"{name:40} {baseline[name]['median'] * 1e6:12.2f} us -> "
+            f"{result['median'] * 1e6:12.2f} us {change:+8.1%}"
+            + (" REGRESSION" if regression else "")
+        )
+    return ok
+
+
+def main():
+    args = parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["benchmarks"]
+
+    output = os.path.abspath(args.output) if args.output else None
+    directory = tempfile.TemporaryDirectory(prefix="itho-benchmark-")
+    # itho-wpu.py reads heatpump.sqlite and writes its cache in the working directory
+    os.chdir(directory.name)
+    create_database("heatpump.sqlite")
+
+    wpu_module = load_wpu_module()
+    for name in ["itho_i2c", "itho_decode", "itho_metadata", "itho_emulator"]:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    wpu_module.logger.setLevel(logging.WARNING)
+
+    metadata = HeatpumpMetadata("heatpump.sqlite").get(listversion)
+    emulator = EmulatedWPU(metadata, delay=0, seed=0)
+    wpu = wpu_module.IthoWPU(False, False, 0, True, transport=emulator)
+
+    results = {}
+    for name, benchmark in get_benchmarks(args, wpu_module, wpu, metadata).items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = benchmark()
+        if baseline is None:
+            print(f"{name:40} {results[name]['median'] * 1e6:12.2f} us")
+    emulator.close()
+    os.chdir("/")
+    directory.cleanup()
+
+    ok = True
+    if baseline is not None:
+        ok = compare(results, baseline, args.max_regression)
+
+    if output:
+        data = {
+            "timestamp": datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "benchmarks": results,
+        }
+        with open(output, "w") as f:
+            json.dump(data, f, indent=2)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Decode captured getdatalog responses in bulk.
+#
+# The input file contains one response per line in hexadecimal, optionally preceded by a unix
+# timestamp and a comma: `1614586800.0,82a40101...`.
+#
+# Dependencies: python3-numpy
+
+import argparse
+import sys
+from itho_cache import IthoWPUCache, get_device_key
+from itho_decode import DatalogDecoder, get_datalog_structure
+from itho_metadata import HeatpumpMetadata
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Decode captured Itho WPU datalog responses",
+    )
+    parser.add_argument("--input", nargs="?", required=True, help="File with datalog responses")
+    parser.add_argument(
+        "--output",
+        nargs="?",
+        help="Write the decoded columns to this .npz file instead of CSV on stdout",
+    )
+    parser.add_argument(
+        "--cache-file",
+        nargs="?",
+        default="itho-wpu-cache.json",
+        help="Cache file of itho-wpu.py with the nodeid and datatype of the WPU",
+    )
+    parser.add_argument("--nodeid", nargs="?", help="getnodeid response (hex)")
+    parser.add_argument("--datatype", nargs="?", help="getdatatype response (hex)")
+    parser.add_argument(
+        "--sqlite-db", nargs="?", default="heatpump.sqlite", help="Itho Database file"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        nargs="?",
+        type=int,
+        default=100000,
+        help="Number of responses decoded at once",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def get_decoder(args):
+    nodeid = bytes.fromhex(args.nodeid) if args.nodeid else None
+    datatype = bytes.fromhex(args.datatype) if args.datatype else None
+    if nodeid is None or datatype is None:
+        # The responses are captured earlier, so expired cache entries are still valid
+        cache = IthoWPUCache(args.cache_file)
+        nodeid = nodeid or cache.get("nodeid", expired=True)
+        serial = cache.get("serial", expired=True)
+        if datatype is None and nodeid is not None and serial is not None:
+            datatype = cache.get("datatype", get_device_key(serial, nodeid), expired=True)
+    if nodeid is None or datatype is None:
+        print("Error: nodeid and datatype of the WPU are required")
+        sys.exit(1)
+
+    listversion = nodeid[10]
+    metadata = HeatpumpMetadata(args.sqlite_db).get(listversion)
+    if metadata is None or metadata.datalabels is None:
+        print(f"Error: datalabels not found in database for version {listversion}")
+        sys.exit(1)
+    return DatalogDecoder(get_datalog_structure(datatype, metadata.datalabels))
+
+
+def read_chunks(path, chunk_size):
+    timestamps = []
+    frames = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            timestamp, _, frame = line.rpartition(",")
+            timestamps.append(float(timestamp) if timestamp else float("nan"))
+            frames.append(bytes.fromhex(frame))
+            if len(frames) >= chunk_size:
+                yield timestamps, frames
+                timestamps, frames = [], []
+    if frames:
+        yield timestamps, frames
+
+
+def decode_chunk(np, decoder, timestamps, frames):
+    """
+    Validate and decode a chunk of responses. Returns the timestamps and decoded columns of
+    the valid responses and the number of invalid responses.
+    """
+    lengths = np.array([len(frame) for frame in frames])
+    # Responses of one WPU all have the same length
+    length = max(int(np.bincount(lengths).argmax()), decoder.size + 6)
+    same_length = lengths == length
+    data = np.frombuffer(
+        b"".join(frame for frame, ok in zip(frames, same_length) if ok), dtype=np.uint8
+    ).reshape(-1, length)
+
+    checksum = (256 - (0x80 + data[:, :-1].sum(axis=1, dtype=np.int64)) % 256) % 256
+    valid = (
+        (checksum == data[:, -1])
+        & (data[:, 1] == 0xA4)
+        & (data[:, 2] == 0x01)
+        & (data[:, 3] == 0x01)
+        & (data[:, 4] == length - 6)
+    )
+    columns = decoder.decode_many(np, data[valid, 5 : 5 + decoder.size])  # noqa: E203
+    timestamps = np.asarray(timestamps)[same_length][valid]
+    return timestamps, columns, len(frames) - np.count_nonzero(valid)
+
+
+def main():
+    import numpy as np
+
+    args = parse_args()
+    decoder = get_decoder(args)
+
+    invalid = 0
+    results = []
+    if args.output is None:
+        print(",".join(["timestamp"] + decoder.labels))
+    for timestamps, frames in read_chunks(args.input, args.chunk_size):
+        timestamps, columns, n = decode_chunk(np, decoder, timestamps, frames)
+        invalid += n
+        if args.output is None:
+            table = np.column_stack([timestamps] + [columns[x] for x in decoder.labels])
+            np.savetxt(sys.stdout, table, delimiter=",", fmt="%.10g")
+        else:
+            results.append((timestamps, columns))
+
+    if args.output is not None:
+        np.savez(
+            args.output,
+            timestamp=np.concatenate([r[0] for r in results]) if results else np.array([]),
+            **{
+                label: np.concatenate([r[1][label] for r in results]) if results else []
+                for label in decoder.labels
+            },
+        )
+    if invalid:
+        print(f"Skipped {invalid} invalid responses", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Query the local datalog store written by `itho-wpu.py --store-dir`.
+#
+# Dependencies: python3-numpy
+
+import argparse
+import datetime
+import sys
+from itho_store import apply_retention, list_partitions, query
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Query the local Itho WPU datalog store",
+    )
+    parser.add_argument("--store-dir", nargs="?", required=True, help="Datalog store directory")
+    parser.add_argument(
+        "--from",
+        dest="start",
+        nargs="?",
+        type=datetime.datetime.fromisoformat,
+        help="Start time (ISO 8601, local time unless a timezone is given)",
+    )
+    parser.add_argument(
+        "--to",
+        dest="end",
+        nargs="?",
+        type=datetime.datetime.fromisoformat,
+        help="End time (ISO 8601), defaults to now",
+    )
+    parser.add_argument(
+        "--label",
+        nargs="+",
+        help="Datalabels to return, defaults to all datalabels",
+    )
+    parser.add_argument(
+        "--bucket",
+        nargs="?",
+        type=float,
+        help="Downsample to the minimum, maximum and average per bucket of this many seconds",
+    )
+    parser.add_argument(
+        "--retention-days",
+        nargs="?",
+        type=int,
+        help="Remove data older than this many days",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def get_labels(directory):
+    import json
+    import os
+
+    labels = []
+    for _, path in list_partitions(directory):
+        with open(os.path.join(path, "schema.json")) as f:
+            for field in json.load(f)["fields"]:
+                if field["label"] not in labels:
+                    labels.append(field["label"])
+    return labels
+
+
+def format_time(ms):
+    return datetime.datetime.fromtimestamp(ms / 1000).isoformat(timespec="milliseconds")
+
+
+def format_value(value):
+    return "" if value != value else f"{value:g}"  # NaN is not equal to itself
+
+
+def main():
+    args = parse_args()
+
+    if args.retention_days is not None:
+        apply_retention(args.store_dir, args.retention_days)
+        if args.start is None:
+            return
+
+    if args.start is None:
+        print("Error: --from is required")
+        sys.exit(1)
+    start = args.start.astimezone()
+    end = (args.end or datetime.datetime.now()).astimezone()
+    labels = args.label or get_labels(args.store_dir)
+
+    timestamps, values = query(args.store_dir, labels, start, end, args.bucket)
+    if args.bucket is None:
+        print(",".join(["time"] + labels))
+        for i, ms in enumerate(timestamps):
+            print(",".join([format_time(ms)] + [format_value(values[x][i]) for x in labels]))
+    else:
+        header = ["time"]
+        for label in labels:
+            header += [f"{label}_min", f"{label}_max", f"{label}_avg"]
+        print(",".join(header))
+        for i, ms in enumerate(timestamps):
+            row = [format_time(ms)]
+            for label in labels:
+                row += [format_value(v[i]) for v in values[label]]
+            print(",".join(row))
+
+
+if __name__ == "__main__":
+    main()
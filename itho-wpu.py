@@ -1,15 +1,32 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import datetime
 import logging
 import queue
+import signal
 import sys
 import time
 import os
 import json
-import db
-from collections import namedtuple
-from itho_i2c import I2CMaster, I2CSlave
+from itho_cache import IthoWPUCache, get_cache_key, get_device_key, global_keys
+from itho_i2c import I2CBus, I2CMaster, default_response_timeout
+from itho_profile import get_process_age, profiler
+from itho_retry import CircuitBreaker, RetryPolicies
+from itho_results import (
+    format_counter,
+    format_datatype,
+    format_manual,
+    format_nodeid,
+    format_serial,
+    format_setting,
+    parse_counters,
+    parse_manual,
+    parse_nodeid,
+    parse_serial,
+    parse_setting,
+)
 
 logger = logging.getLogger("stdout")
 logger.setLevel(logging.INFO)
@@ -31,15 +48,27 @@ actions = {
 }
 
 
+action_choices = list(actions.keys()) + ["getsettings"]
+# Actions that take an --id
+id_actions = ["getsetting", "setsetting", "getmanual", "setmanual"]
+# Actions of which the results are exported
+exported_actions = ["getdatalog", "getcounters"]
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Itho WPU i2c master")
 
-    parser.add_argument(
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
         "--action",
+        nargs="+",
+        choices=action_choices,
+        help="Execute one or more actions",
+    )
+    group.add_argument(
+        "--plan",
         nargs="?",
-        required=True,
-        choices=list(actions.keys()) + ["getsettings"],
-        help="Execute an action",
+        help='Execute the actions in this JSON file: [{"action": "getsetting", "id": 1}, ...]',
     )
     parser.add_argument(
         "--id",
@@ -74,211 +103,487 @@ def parse_args():
         default=60,
         help="Slave timeout in seconds when --slave-only",
     )
+    parser.add_argument(
+        "--response-timeout",
+        nargs="?",
+        type=float,
+        default=default_response_timeout,
+        help="Seconds to wait for a response before a request is sent again",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        nargs="?",
+        type=int,
+        default=4,
+        help="Number of requests kept in flight with --action getsettings",
+    )
+    parser.add_argument(
+        "--store-dir",
+        nargs="?",
+        help="Store datalogs in a local columnar store in this directory (see itho-store.py)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        nargs="?",
+        type=int,
+        help="Serve the latest results as Prometheus metrics on this port when --daemon",
+    )
     parser.add_argument("--no-cache", action="store_true", help="Don't use local cache")
+    parser.add_argument(
+        "--cache-file",
+        nargs="?",
+        default="itho-wpu-cache.json",
+        help="Local cache file",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        nargs="?",
+        help='Cache TTLs in seconds as JSON, overriding the defaults: {"setting": 600}',
+    )
+    parser.add_argument(
+        "--record",
+        nargs="?",
+        help="Record all I2C requests and responses to this file",
+    )
+    parser.add_argument(
+        "--replay",
+        nargs="?",
+        help="Play back a file of --record instead of using the I2C bus",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="Print the time spent in each stage at exit, or write it as JSON to FILE",
+    )
+    parser.add_argument(
+        "--emulate",
+        nargs="?",
+        type=int,
+        metavar="LISTVERSION",
+        help="Emulate a WPU of this list version instead of using the I2C bus",
+    )
+    parser.add_argument(
+        "--emulate-delay",
+        nargs="?",
+        type=float,
+        default=0.02,
+        help="Response time in seconds of the emulated WPU",
+    )
+    parser.add_argument(
+        "--emulate-faults",
+        nargs="?",
+        help='Fault probabilities of the emulated WPU: {"drop": 0.1, "corrupt": 0.01, '
+        '"wrong_length": 0.01, "jitter": 0.05}',
+    )
+    parser.add_argument(
+        "--replay-speed",
+        nargs="?",
+        type=float,
+        default=1.0,
+        help="Speed factor of --replay, 0 returns responses immediately",
+    )
+    parser.add_argument(
+        "--snapshot",
+        nargs="?",
+        help="Keep the settings in this file with getsettings and print what changed",
+    )
+    parser.add_argument(
+        "--settings-slice",
+        nargs="?",
+        type=int,
+        help="Only read this many settings from the WPU with getsettings and --snapshot, the "
+        "ones read longest ago",
+    )
+    parser.add_argument(
+        "--devices",
+        nargs="?",
+        metavar="FILE",
+        help="Poll the WPUs in this JSON file one after another instead of one WPU, and print "
+        "the results as one JSON line per WPU",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and repeat the action every --interval seconds",
+    )
+    parser.add_argument(
+        "--interval",
+        nargs="?",
+        type=float,
+        default=60,
+        help="Poll interval in seconds when --daemon",
+    )
+    parser.add_argument(
+        "--schedule",
+        action="store_true",
+        help='With --daemon, run every action of --plan at its own "interval" in seconds, in '
+        'order of "priority" (lower first), and skip runs more than "deadline" seconds late',
+    )
     parser.add_argument(
         "--export-to-influxdb",
         action="store_true",
         help="Export results to InfluxDB",
     )
+    parser.add_argument(
+        "--deadband",
+        action="store_true",
+        help="Only export datalog fields that changed more than their deadband",
+    )
+    parser.add_argument(
+        "--deadband-config",
+        nargs="?",
+        help='Deadband overrides per datalabel, or "action:label" for other actions: '
+        '{"label": {"deadband": 0.5, "heartbeat": 60}}',
+    )
+    parser.add_argument(
+        "--heartbeat",
+        nargs="?",
+        type=float,
+        default=300,
+        help="Export unchanged datalog fields at least every this many seconds when --deadband",
+    )
+    parser.add_argument(
+        "--spool-dir",
+        nargs="?",
+        help="Spool exported results in this directory until InfluxDB is reachable",
+    )
+    parser.add_argument(
+        "--spool-max-mb",
+        nargs="?",
+        type=int,
+        default=50,
+        help="Maximum size of the spool in MB, the oldest results are removed first",
+    )
 
     args = parser.parse_args()
     return args
 
 
 class IthoWPU:
-    def __init__(self, master_only, slave_only, slave_timeout, no_cache):
+    def __init__(
+        self,
+        master_only,
+        slave_only,
+        slave_timeout,
+        no_cache,
+        response_timeout=default_response_timeout,
+        response_timeouts=None,
+        transport=None,
+        cache_file="itho-wpu-cache.json",
+        cache_ttls=None,
+        bus=1,
+        master_address=0x41,
+        slave_address=0x40,
+        metadata=None,
+    ):
+        """
+        :param metadata: HeatpumpMetadata, can be shared by several IthoWPUs. By default
+            heatpump.sqlite is opened when metadata is needed.
+        """
         self.master_only = master_only
         self.slave_only = slave_only
         self.slave_timeout = slave_timeout
+        self.response_timeout = response_timeout
+        self.response_timeouts = response_timeouts
+        # Kept for the lifetime of the IthoWPU, also while the bus is closed between calls
+        self.policies = RetryPolicies(response_timeout, response_timeouts)
+        self.breaker = CircuitBreaker()
         self._q = queue.Queue()
         self.no_cache = no_cache
-        self.cache = IthoWPUCache()
-        self.nodeid = self.call("getnodeid")
-        self.datatype = self.call("getdatatype")
-        self.heatpump_db = db.sqlite("heatpump.sqlite")
-
-    def call(self, action, identifier=None, datatype=None, value=None, check=True):
-        if not self.no_cache:
-            response = self.cache.call(action.replace("get", ""))
+        # Round-trip times in seconds of the most recent I2C requests
+        self.latencies = collections.deque(maxlen=100)
+        self.bus = bus
+        self.master_address = master_address
+        if transport is None:
+            transport = I2CBus(bus, master_address, slave_address, not master_only, not slave_only)
+        self.transport = transport
+        self._open = False
+        self._master = None
+        self._datalog_decoders = {}  # (fingerprint, heatpump.sqlite mtime): DatalogDecoder
+        self.cache = None if no_cache else IthoWPUCache(cache_file, cache_ttls)
+        # The nodeid, datatype and metadata are retrieved when they are first used
+        self._nodeid = None
+        self._serial = None
+        self._datatype = None
+        self._metadata = metadata
+        self._device_key = None
+
+    @property
+    def nodeid(self):
+        if self._nodeid is None:
+            self._nodeid = self.call("getnodeid")
+        return self._nodeid
+
+    @property
+    def serial(self):
+        if self._serial is None:
+            self._serial = self.call("getserial")
+        return self._serial
+
+    @property
+    def datatype(self):
+        if self._datatype is None:
+            self._datatype = self.call("getdatatype")
+        return self._datatype
+
+    @property
+    def device_key(self):
+        """
+        Key of the device in the cache, None when the serial or nodeid isn't available.
+        """
+        if self._device_key is None:
+            if self.serial is None or self.nodeid is None:
+                return None
+            self._device_key = get_device_key(self.serial, self.nodeid)
+        return self._device_key
+
+    def reidentify(self):
+        """
+        Read the nodeid, serial and datatype from the WPU instead of the cache, after a
+        response that doesn't match them, e.g. because the controller was replaced. Returns
+        True when they changed.
+        """
+        previous = (self._nodeid, self._serial, self._datatype)
+        self._nodeid = self.call("getnodeid", cached=False)
+        self._serial = self.call("getserial", cached=False)
+        self._device_key = None
+        self._datatype = self.call("getdatatype", cached=False)
+        changed = (self._nodeid, self._serial, self._datatype) != previous
+        if changed:
+            logger.warning("The nodeid, serial or datatype of the WPU changed")
+        return changed
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            from itho_metadata import HeatpumpMetadata
+
+            self._metadata = HeatpumpMetadata("heatpump.sqlite")
+        return self._metadata
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def open(self):
+        """
+        Open the transport. While open, calls reuse the same pigpio connection and /dev/i2c
+        handles instead of setting them up and tearing them down every time.
+        """
+        if self._open:
+            return
+        with profiler.stage("transport_open"):
+            self.transport.open(self._q)
+        if not self.slave_only:
+            self._master = I2CMaster(
+                address=self.master_address,
+                bus=self.bus,
+                queue=self._q,
+                timeout=self.response_timeout,
+                timeouts=self.response_timeouts,
+                transport=self.transport,
+                policies=self.policies,
+                breaker=self.breaker,
+            )
+        self._open = True
+
+    def close(self):
+        if self._master is not None:
+            self._master.close()
+            self._master = None
+        self.transport.close()
+        self._open = False
+
+    def _get_cache_location(self, action, identifier=None):
+        """
+        Return the cache key and device key of the response to an action, or None when it
+        isn't cached.
+        """
+        if self.cache is None:
+            return None
+        key = get_cache_key(action, identifier)
+        if key is None or self.cache.get_ttl(key) == 0:
+            return None
+        if key in global_keys:
+            return key, None
+        device = self.device_key
+        if device is None:
+            return None
+        return key, device
+
+    def call(self, action, identifier=None, datatype=None, value=None, check=True, cached=True):
+        """
+        Execute an action. Responses of get actions are read from the cache, unless `cached` is
+        False.
+        """
+        location = self._get_cache_location(action, identifier)
+        if location is not None and cached and action.startswith("get"):
+            response = self.cache.get(*location)
             if response is not None:
-                logger.debug(f"Response (from cache): {response}")
+                logger.debug(f"Response (from cache): {response.hex(' ')}")
                 return response
 
         response = None
 
-        if not self.master_only:
-            slave = I2CSlave(address=0x40, queue=self._q)
-            slave.set_callback()
-            if self.slave_only:
-                time.sleep(self.slave_timeout)
+        keep_open = self.is_open
+        self.open()
 
-        if not self.slave_only:
-            master = I2CMaster(address=0x41, bus=1, queue=self._q)
-            if action:
-                response = master.execute_action(action, identifier, datatype, value, check)
-                logger.debug(f"Response: {response}")
-            master.close()
+        if self.slave_only:
+            time.sleep(self.slave_timeout)
+        elif action:
+            response = self._master.execute_action(action, identifier, datatype, value, check)
+            if response is not None:
+                logger.debug(f"Response: {response.hex(' ')}")
+            self.latencies.extend(self._master.latencies)
+            self._master.latencies.clear()
 
-        if not self.master_only:
-            slave.close()
+        if not keep_open:
+            self.close()
 
-        self.cache.set(action.replace("get", ""), response)
+        if location is not None:
+            if action.startswith("set"):
+                # The response to setsetting is the updated setting, setmanual doesn't respond
+                # with the manual operation
+                self.cache.invalidate(*location)
+            if response is not None and (action.startswith("get") or action == "setsetting"):
+                self.cache.set(location[0], response, location[1])
 
         return response
 
+    def call_many(self, action, identifiers, depth=4, cached=True):
+        """
+        Execute a read action for many identifiers in a single bus session with up to `depth`
+        requests in flight. Yields (identifier, response) tuples as responses arrive, cached
+        responses first unless `cached` is False.
+        """
+        missing = []
+        for identifier in identifiers:
+            location = self._get_cache_location(action, identifier) if cached else None
+            response = None if location is None else self.cache.get(*location)
+            if response is None:
+                missing.append(identifier)
+            else:
+                logger.debug(f"Response (from cache): {response.hex(' ')}")
+                yield identifier, response
+        if not missing:
+            return
+
+        keep_open = self.is_open
+        self.open()
+        try:
+            for identifier, response in self._master.execute_pipelined(action, missing, depth):
+                if response is not None:
+                    logger.debug(f"Response: {response.hex(' ')}")
+                    location = self._get_cache_location(action, identifier)
+                    if location is not None:
+                        self.cache.set(location[0], response, location[1])
+                yield identifier, response
+            self.latencies.extend(self._master.latencies)
+            self._master.latencies.clear()
+        finally:
+            if not keep_open:
+                self.close()
+
     def get_listversion_from_nodeid(self):
         if self.nodeid is None:
             return
-        return int(self.nodeid[10], 0)
+        return self.nodeid[10]
 
     def get_datalog_structure(self):
-        listversion = self.get_listversion_from_nodeid()
-        datalabel_version = self.heatpump_db.execute(
-            f"SELECT datalabel FROM versiebeheer WHERE version = {listversion}"
-        )[0]["datalabel"]
-        if datalabel_version is None or not type(datalabel_version) == int:
-            logger.error(f"Datalabel not found in database for version {listversion}")
-            return None
-        datalabel = self.heatpump_db.execute(
-            f"SELECT name, title, tooltip, unit FROM datalabel_v{datalabel_version} order by id"
-        )
+        from itho_decode import get_datalog_structure
 
-        if len(self.datatype[5:-1]) != len(datalabel):
-            logger.warning(
-                f"Number of datatype items ({len(self.datatype[5:-1])}) is not equal to "
-                f"the number of datalabels ({len(datalabel)}) in the database."
+        metadata = self.get_metadata()
+        if metadata is None or metadata.datalabels is None:
+            logger.error(
+                "Datalabel not found in database for version "
+                f"{self.get_listversion_from_nodeid()}"
             )
+            return None
+        return get_datalog_structure(self.datatype, metadata.datalabels)
 
-        Field = namedtuple("Field", "index type label description")
-
-        datalog = []
-        index = 0
-        for dl, dt in zip(datalabel, self.datatype[5:-1]):
-            dt = int(dt, 0)
-            description = dl["title"].title()
-            if dl["unit"] is not None:
-                description = f"{description} ({dl['unit']})"
-            description = f"{description} ({dl['name'].lower()})"
-            datalog.append(Field(index, dt, dl["name"].lower(), description))
-
-            if dt in [0x0, 0x1, 0x2, 0xC, 0xF, 0x6C, 0x80, 0x81, 0x82, 0x8F]:
-                index = index + 1
-            elif dt in [0x10, 0x11, 0x12, 0x13, 0x14, 0x51, 0x90, 0x91, 0x92]:
-                index = index + 2
-            elif dt in [0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0xA0, 0xA1, 0xA2, 0xA3, 0xA4, 0xA5]:
-                index = index + 4
-            else:
-                logger.error(f"Unknown data type for label {dl['name']}: {dt}")
-                return datalog
-        return datalog
+    def get_datalog_decoder(self):
+        """
+        Return the datalog decoder for the list version and datatype of the WPU, or None when
+        the datalog structure isn't available. Decoders are compiled once and kept in memory
+        and in the local cache, until heatpump.sqlite changes.
+        """
+        from itho_decode import DatalogDecoder
 
-    def get_counters(self):
         listversion = self.get_listversion_from_nodeid()
-        counters_version = self.heatpump_db.execute(
-            f"SELECT counters FROM versiebeheer WHERE version = {listversion}"
-        )[0]["counters"]
-        if counters_version is None or not type(counters_version) == int:
-            logger.error(f"Counters not found in database for version {listversion}")
+        if listversion is None or self.datatype is None:
             return None
-        settings = self.heatpump_db.execute(
-            "SELECT id, name, title, tooltip, unit " + f"FROM counters_v{counters_version}"
-        )
-        return settings
+        fingerprint = DatalogDecoder.fingerprint(listversion, self.datatype)
+        heatpump_db_mtime = os.path.getmtime(self.metadata.db_file)
+        key = (fingerprint, heatpump_db_mtime)
+        if key in self._datalog_decoders:
+            return self._datalog_decoders[key]
+
+        cached = None if self.cache is None else self.cache.get("datalog_decoder")
+        if (
+            cached is not None
+            and cached["fingerprint"] == fingerprint
+            and cached["heatpump_db_mtime"] == heatpump_db_mtime
+        ):
+            decoder = DatalogDecoder.from_dict(cached)
+        else:
+            structure = self.get_datalog_structure()
+            if structure is None:
+                return None
+            decoder = DatalogDecoder(structure)
+            cached = decoder.to_dict()
+            cached["fingerprint"] = fingerprint
+            cached["heatpump_db_mtime"] = heatpump_db_mtime
+            if self.cache is not None:
+                self.cache.set("datalog_decoder", cached)
+        self._datalog_decoders[key] = decoder
+        return decoder
+
+    def get_metadata(self):
+        return self.metadata.get(self.get_listversion_from_nodeid())
+
+    def get_counters(self):
+        metadata = self.get_metadata()
+        if metadata is None or metadata.counters is None:
+            logger.error(
+                f"Counters not found in database for version {self.get_listversion_from_nodeid()}"
+            )
+            return None
+        return metadata.counters
 
     def get_settings(self):
-        listversion = self.get_listversion_from_nodeid()
-        parameterlist_version = self.heatpump_db.execute(
-            f"SELECT parameterlist FROM versiebeheer WHERE version = {listversion}"
-        )[0]["parameterlist"]
-        if parameterlist_version is None or not type(parameterlist_version) == int:
-            logger.error(f"Parameterlist not found in database for version {listversion}")
+        metadata = self.get_metadata()
+        if metadata is None or metadata.settings is None:
+            logger.error(
+                "Parameterlist not found in database for version "
+                f"{self.get_listversion_from_nodeid()}"
+            )
             return None
-        settings = self.heatpump_db.execute(
-            "SELECT id, name, min, max, def, title, description, unit "
-            + f"FROM parameterlijst_v{parameterlist_version}"
-        )
-        return settings
+        return list(metadata.settings.values())
 
     def get_setting_by_id(self, settingid):
-        listversion = self.get_listversion_from_nodeid()
-        parameterlist_version = self.heatpump_db.execute(
-            f"SELECT parameterlist FROM versiebeheer WHERE version = {listversion}"
-        )[0]["parameterlist"]
-        if parameterlist_version is None or not type(parameterlist_version) == int:
-            logger.error(f"Parameterlist not found in database for version {listversion}")
-            return None
-        setting_details = self.heatpump_db.execute(
-            "SELECT name, min, max, def, title, description, unit "
-            + f"FROM parameterlijst_v{parameterlist_version} WHERE id = {settingid}"
-        )
-        if len(setting_details) != 1:
+        metadata = self.get_metadata()
+        if metadata is None or metadata.settings is None:
+            logger.error(
+                "Parameterlist not found in database for version "
+                f"{self.get_listversion_from_nodeid()}"
+            )
             return None
-        return setting_details[0]
+        return metadata.settings.get(settingid)
 
     def get_manual_by_id(self, manualid):
-        listversion = self.get_listversion_from_nodeid()
-        handbed_version = self.heatpump_db.execute(
-            f"SELECT handbed FROM versiebeheer WHERE version = {listversion}"
-        )[0]["handbed"]
-        if handbed_version is None or not type(handbed_version) == int:
-            logger.error(f"Handbed not found in database for version {listversion}")
-            return None
-        manual_details = self.heatpump_db.execute(
-            "SELECT name, min, max, def, title, tooltip, unit "
-            + f"FROM handbed_v{handbed_version} WHERE id = {manualid}"
-        )
-        if len(manual_details) != 1:
-            return None
-        return manual_details[0]
-
-
-class IthoWPUCache:
-    def __init__(self):
-        self._cache_file = "itho-wpu-cache.json"
-        self._cache_data = {
-            "nodeid": None,
-            "serial": None,
-            "datatype": None,
-            "schema_version": "1",
-        }
-        self._read_cache()
-
-    def _read_cache(self):
-        if not os.path.exists(self._cache_file):
-            logger.debug(f"Not loading cache file: {self._cache_file} does not exist")
-            return
-        with open(self._cache_file) as cache_file:
-            cache_data = json.load(cache_file)
-            logger.debug(f"Loading local cache: {json.dumps(cache_data)}")
-            for key in ["nodeid", "serial", "datatype"]:
-                if key in cache_data:
-                    self._cache_data[key] = cache_data[key]
-
-    def _write_cache(self):
-        with open(self._cache_file, "w") as cache_file:
-            logger.debug(f"Writing to local cache: {json.dumps(self._cache_data)}")
-            json.dump(self._cache_data, cache_file)
-
-    def call(self, action):
-        if action not in ["nodeid", "serial", "datatype"]:
-            logger.debug(f"Cache for '{action}' is not supported")
-            return None
-        logger.debug(f"Reading '{action}' from local cache")
-        if self._cache_data[action] is None:
-            logger.debug(f"Action '{action}' is not present in local cache")
-        return self._cache_data[action]
-
-    def set(self, action, value):
-        if action not in ["nodeid", "serial", "datatype"]:
-            logger.debug(f"Cache for '{action}' is not supported")
+        metadata = self.get_metadata()
+        if metadata is None or metadata.manuals is None:
+            logger.error(
+                f"Handbed not found in database for version {self.get_listversion_from_nodeid()}"
+            )
             return None
-        logger.debug(f"Writing '{action}' to local cache: {value}")
-        self._cache_data[action] = value
-        self._write_cache()
+        return metadata.manuals.get(manualid)
 
 
 def is_messageclass_valid(action, response):
-    if int(response[1], 0) != actions[action][0] and int(response[2], 0) != actions[action][1]:
+    if response[1] != actions[action][0] and response[2] != actions[action][1]:
         logger.error(
             f"Response MessageClass != {actions[action][0]} {actions[action][1]} "
             f"({action}), but {response[1]} {response[2]}"
@@ -288,151 +593,146 @@ def is_messageclass_valid(action, response):
 
 
 def process_response(action, response, args, wpu):
-    if int(response[3], 0) != 0x01:
-        logger.error(f"Response MessageType != 0x01 (response), but {response[3]}")
+    """
+    Log the result of an action and return it: a dict of name: value for getdatalog and
+    getcounters, otherwise a result object of itho_results.
+    """
+    if response[3] != 0x01:
+        logger.error(f"Response MessageType != 0x01 (response), but 0x{response[3]:02x}")
         return
     if not is_messageclass_valid(action, response):
         return
 
     if action == "getdatalog":
-        measurements = process_datalog(response, wpu)
-        if args.export_to_influxdb:
-            from itho_export import export_to_influxdb
-
-            export_to_influxdb(action, measurements)
+        return process_datalog(response, wpu)
     elif action == "getsetting":
-        process_setting(response, wpu)
+        return process_setting(response, wpu)
     elif action == "getmanual":
-        process_manual(response, wpu)
+        return process_manual(response, wpu)
     elif action == "getnodeid":
-        process_nodeid(response)
+        return process_nodeid(response)
     elif action == "getserial":
-        process_serial(response)
+        return process_serial(response)
     elif action == "getcounters":
-        process_counters(response, wpu)
+        return process_counters(response, wpu)
 
 
 def process_nodeid(response):
-    hardware_info = {
-        0: {
-            "name": "HCCP",
-            "type": {
-                13: "WPU",
-                15: "Autotemp",
-            },
-        }
-    }
-    manufacturergroup = (int(response[5], 0) << 8) + int(response[6], 0)
-    manufacturer = hardware_info[int(response[7], 0)]["name"]
-    hardwaretype = hardware_info[int(response[7], 0)]["type"][int(response[8], 0)]
-    productversion = int(response[9], 0)
-    listversion = int(response[10], 0)
-
-    logger.info(
-        f"ManufacturerGroup: {manufacturergroup}, Manufacturer: {manufacturer}, "
-        f"HardwareType: {hardwaretype}, ProductVersion: {productversion}, "
-        f"ListVersion: {listversion}"
-    )
+    nodeid = parse_nodeid(response)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(format_nodeid(nodeid))
+    return nodeid
 
 
 def process_serial(response):
-    serial = (int(response[5], 0) << 16) + (int(response[6], 0) << 8) + int(response[7], 0)
-    logger.info(f"Serial: {serial}")
+    serial = parse_serial(response)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(format_serial(serial))
+    return serial
 
 
 def process_counters(response, wpu):
+    """
+    Return the counters as a dict of name: value, like process_datalog.
+    """
     counters = wpu.get_counters()
-    message = response[5:]
-    for c in counters:
-        index = int(c["id"]) * 2
-        num = format_datatype(c["name"], message[index : index + 2], 0x10)  # noqa: E203
-
-        logger.info(
-            "{}. {} ({}): {}{}".format(
-                int(c["id"]),
-                c["title"].title(),
-                c["name"].lower(),
-                num,
-                " " + c["unit"] if c["unit"] is not None else "",
-            )
-        )
+    if counters is None:
+        return None
+    results = parse_counters(response, counters)
+    if logger.isEnabledFor(logging.INFO):
+        for counter in results:
+            logger.info(format_counter(counter))
+    return {counter.name.lower(): counter.value for counter in results}
 
 
 def process_datalog(response, wpu):
-    datalog = wpu.get_datalog_structure()
-    message = response[5:]
-    measurements = {}
-    for d in datalog:
-        if d.type == 0x0 or d.type == 0xC:
-            length = 1
-        elif d.type == 0x10 or d.type == 0x12 or d.type == 0x90 or d.type == 0x92:
-            length = 2
-        elif d.type == 0x20:
-            length = 4
-        else:
-            logger.error(f"Unknown message type for datalog {d.label}: {d.type}")
-        num = format_datatype(d.label, message[d.index : d.index + length], d.type)  # noqa: E203
-        logger.info(f"{d.description}: {num}")
-        measurements[d.label] = num
-    return measurements
-
+    decoder = wpu.get_datalog_decoder()
+    if decoder is None:
+        logger.error("Can't decode the datalog, the datalog structure isn't available")
+        return None
+    message = memoryview(response)[5:]
+    with profiler.stage("decode"):
+        values = decoder.decode_values(message)
+    if values is None and wpu.cache is not None and wpu.reidentify():
+        # The datalog didn't match the cached datatype, decode it with the WPU's current one
+        return process_datalog(response, wpu)
+    if values is None:
+        return None
+    if logger.isEnabledFor(logging.INFO):
+        for description, num in zip(decoder.descriptions, values):
+            logger.info(f"{description}: {num}")
+    return dict(zip(decoder.labels, values))
 
-def parse_setting(response, wpu):
-    message = response[5:]
 
-    settingid = int(message[17], 0)
+def process_setting(response, wpu):
+    settingid = response[22]
     setting = wpu.get_setting_by_id(settingid)
     if setting is None:
         logger.error(f"Setting '{settingid}' is invalid")
-        return
+        return None
+    setting = parse_setting(response, setting)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(format_setting(setting))
+    return setting
 
-    datatype = message[16]
-    value = format_datatype(setting["name"], message[0:4], datatype)
-    minimum = format_datatype(setting["name"], message[4:8], datatype)
-    maximum = format_datatype(setting["name"], message[8:12], datatype)
-    step = format_datatype(setting["name"], message[12:16], datatype)
 
-    return value, minimum, maximum, step
+def process_settings(wpu, args):
+    """
+    Return the settings that were read as a list of itho_results.Setting.
+    """
+    settings = wpu.get_settings()
+    if settings is None:
+        return None
+    settingids = [int(setting["id"]) for setting in settings]
+    settings = []
+    if not args.snapshot:
+        for _, response in wpu.call_many("getsetting", settingids, args.pipeline_depth):
+            if response is not None:
+                with profiler.stage("process_response"):
+                    setting = process_response("getsetting", response, args, wpu)
+                if setting is not None:
+                    settings.append(setting)
+        return settings
 
+    from itho_snapshot import SettingsSnapshot
 
-def process_setting(response, wpu):
-    message = response[5:]
-
-    settingid = int(message[17], 0)
-    setting = wpu.get_setting_by_id(settingid)
-    if setting is None:
-        logger.error(f"Setting '{settingid}' is invalid")
+    if wpu.serial is None or wpu.nodeid is None:
         return
+    serial = parse_serial(wpu.serial).serial
+    snapshot = SettingsSnapshot(args.snapshot, serial, wpu.nodeid[5:-1].hex())
+    if args.settings_slice:
+        # Spread reading all settings over several runs
+        settingids = snapshot.get_oldest(settingids, args.settings_slice)
+    # The snapshot keeps the time every setting was read from the WPU, so the cache isn't used
+    responses = wpu.call_many("getsetting", settingids, args.pipeline_depth, cached=False)
+    for settingid, response in responses:
+        if response is None:
+            continue
+        with profiler.stage("process_response"):
+            setting = process_response("getsetting", response, args, wpu)
+        if setting is not None:
+            settings.append(setting)
+            snapshot.update(
+                settingid, setting.value, setting.minimum, setting.maximum, setting.step
+            )
 
-    value, minimum, maximum, step = parse_setting(response, wpu)
-
-    logger.info(
-        "{}. {}{}: {} (min: {}, max: {}, step: {})".format(
-            settingid,
-            setting["title"].title(),
-            f' ({setting["unit"]})' if setting["unit"] is not None else "",
-            value,
-            minimum,
-            maximum,
-            step,
-        )
-    )
-
-
-def process_settings(wpu, args):
-    settings = wpu.get_settings()
-    for setting in settings:
-        response = wpu.call("getsetting", int(setting["id"]))
-        if response is not None:
-            process_response("getsetting", response, args, wpu)
+    if snapshot.time is not None and not snapshot.changes:
+        logger.debug("No settings changed since the previous snapshot")
+    for settingid, field, previous, value in snapshot.changes:
+        title = wpu.get_setting_by_id(settingid)["title"].title()
+        logger.info(f"Changed: {settingid}. {title}: {field} {previous} -> {value}")
+    snapshot.save()
+    return settings
 
 
 def process_setsetting(wpu, args):
     logger.info("Current setting:")
-    response = wpu.call("getsetting", int(args.id))
+    response = wpu.call("getsetting", int(args.id), cached=False)
     if response is None:
         return
-    process_response("getsetting", response, args, wpu)
+    setting = process_response("getsetting", response, args, wpu)
+    if setting is None:
+        return
     message = response[5:]
     datatype = message[16]
 
@@ -450,14 +750,16 @@ def process_setsetting(wpu, args):
     logger.debug(f"New setting (input): {value}")
     normalized_value = int(value.replace(".", ""))
     logger.debug(f"New setting (normalized): {normalized_value}")
-    hex_list_value = [hex(v) for v in list(normalized_value.to_bytes(4, byteorder="big"))]
-    logger.debug(f"New setting (hex): {hex_list_value}")
-    parsed_value = format_datatype(args.id, hex_list_value, datatype)
+    bytes_value = normalized_value.to_bytes(4, byteorder="big")
+    logger.debug(f"New setting (hex): {bytes_value.hex(' ')}")
+    parsed_value = format_datatype(args.id, bytes_value, datatype)
     logger.debug(f"New setting (parsed): {parsed_value}")
 
-    _, minimum, maximum, _ = parse_setting(response, wpu)
-    if parsed_value < minimum or parsed_value > maximum:
-        logger.error(f"New value `{parsed_value}` is not between `{minimum}` and `{maximum}`")
+    if parsed_value < setting.minimum or parsed_value > setting.maximum:
+        logger.error(
+            f"New value `{parsed_value}` is not between `{setting.minimum}` and "
+            f"`{setting.maximum}`"
+        )
         return
 
     sure = input(f"Setting `{args.id}` will be changed to `{parsed_value}`? [y/N] ")
@@ -474,25 +776,15 @@ def process_setsetting(wpu, args):
 
 
 def process_manual(response, wpu):
-    message = response[5:]
-
-    manualid = int(message[2], 0)
+    manualid = int.from_bytes(response[6:8], byteorder="big")
     manual = wpu.get_manual_by_id(manualid)
     if manual is None:
         logger.error(f"Manual '{manualid}' is invalid")
-        return
-
-    datatype = message[3]
-    value = format_datatype(manual["name"], message[4:6], datatype)
-
-    logger.info(
-        "{}. {}{}: {}".format(
-            manualid,
-            manual["title"].title(),
-            f' ({manual["unit"]})' if manual["unit"] is not None else "",
-            value,
-        )
-    )
+        return None
+    manual = parse_manual(response, manual)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(format_manual(manual))
+    return manual
 
 
 def process_setmanual(wpu, args):
@@ -520,9 +812,9 @@ def process_setmanual(wpu, args):
     logger.debug(f"New manual operation (input): {value}")
     normalized_value = int(value.replace(".", ""))
     logger.debug(f"New manual operation (normalized): {normalized_value}")
-    hex_list_value = [hex(v) for v in list(normalized_value.to_bytes(2, byteorder="big"))]
-    logger.debug(f"New manual operation (hex): {hex_list_value}")
-    parsed_value = format_datatype(args.id, hex_list_value, datatype)
+    bytes_value = normalized_value.to_bytes(2, byteorder="big")
+    logger.debug(f"New manual operation (hex): {bytes_value.hex(' ')}")
+    parsed_value = format_datatype(args.id, bytes_value, datatype)
     logger.debug(f"New manual operation (parsed): {parsed_value}")
 
     sure = input(f"Manual `{args.id}` will be changed to `{parsed_value}`? [y/N] ")
@@ -532,110 +824,519 @@ def process_setmanual(wpu, args):
         logger.error("Aborted")
         return
 
-    response = wpu.call("setmanual", args.id, int(datatype, 0), normalized_value, args.check)
+    response = wpu.call("setmanual", args.id, datatype, normalized_value, args.check)
 
 
-def format_datatype(name, m, dt):
+def get_deadband_defaults(wpu):
+    from itho_export import get_default_deadband
+
+    metadata = wpu.get_metadata()
+    if metadata is None or metadata.datalabels is None:
+        return {}
+    decoder = wpu.get_datalog_decoder()
+    if decoder is None:
+        return {}
+    units = {dl["name"].lower(): dl["unit"] for dl in metadata.datalabels}
+    return {
+        ("getdatalog", label): get_default_deadband(units.get(label), dt)
+        for _, dt, label, _ in decoder.fields
+    }
+
+
+def get_steps(args):
     """
-    Transform a list of bytes to a readable number based on the datatype.
+    Return the actions to execute as a list of argument namespaces, one per action, from
+    --action or --plan.
+    """
+    if args.plan is None:
+        return [argparse.Namespace(**{**vars(args), "action": action}) for action in args.action]
+    with open(args.plan) as f:
+        plan = json.load(f)
+    steps = []
+    for step in plan:
+        if step.get("action") not in action_choices:
+            raise ValueError(f"Invalid action in {args.plan}: {step}")
+        if "value" in step:
+            step["value"] = str(step["value"])
+        steps.append(argparse.Namespace(**{**vars(args), "id": None, "value": None, **step}))
+    return steps
+
+
+def run_batch(wpu, steps, exporter=None, snapshot=None, store=None, tags=None):
+    """
+    Execute actions in one bus session and return the results as a list of (step, result).
+    The results of the actions in exported_actions are exported as one batch.
+    """
+    keep_open = wpu.is_open
+    wpu.open()
+    results = []
+    try:
+        for step in steps:
+            if len(steps) > 1:
+                logger.info(f"[{step.action}{'' if step.id is None else ' ' + str(step.id)}]")
+            result = run_action(wpu, step, snapshot, store)
+            if result is not None:
+                results.append((step, result))
+    finally:
+        if not keep_open:
+            wpu.close()
+    exported = [(s.action, result) for s, result in results if s.action in exported_actions]
+    if exporter is not None and exported:
+        with profiler.stage("export"):
+            exporter.export_batch(exported, tags)
+    return results
+
+
+def run_action(wpu, args, snapshot=None, store=None):
+    if args.action == "getsettings":
+        return process_settings(wpu, args)
 
-    :param str name: Name/label of the data
-    :param list[str] m: List of bytes in hexadecimal string format
-    :param dt: Datatype
-    :type dt: str or int
+    if args.action == "setsetting":
+        process_setsetting(wpu, args)
+        return
+
+    if args.action == "setmanual":
+        process_setmanual(wpu, args)
+        return
+
+    response = wpu.call(args.action, args.id)
+    if snapshot is not None:
+        snapshot.record_latencies(wpu.latencies)
+        wpu.latencies.clear()
+    if response is None:
+        if snapshot is not None:
+            snapshot.record_error(args.action, "bus")
+        return
+    with profiler.stage("process_response"):
+        result = process_response(args.action, response, args, wpu)
+    if store is not None and args.action == "getdatalog" and result is not None:
+        with profiler.stage("store"):
+            store.append(wpu.get_datalog_decoder(), memoryview(response)[5:])
+    if snapshot is not None and args.action in snapshot.actions:
+        if result is None:
+            snapshot.record_error(args.action, "decode")
+        else:
+            snapshot.update(args.action, result)
+    return result
+
+
+def iter_settings(wpu, args):
+    """
+    Read all settings like process_settings, but yield after every --pipeline-depth settings,
+    so the scheduler can run other jobs in between.
     """
+    settings = wpu.get_settings()
+    if settings is None:
+        return
+    settingids = [int(setting["id"]) for setting in settings]
+    depth = args.pipeline_depth
+    for i in range(0, len(settingids), depth):
+        chunk = settingids[i : i + depth]  # noqa: E203
+        for _, response in wpu.call_many("getsetting", chunk, depth):
+            if response is not None:
+                with profiler.stage("process_response"):
+                    process_response("getsetting", response, args, wpu)
+        yield
 
-    num = None
-    if type(dt) is str:
-        dt = int(dt, 0)
-
-    if dt == 0x0 or dt == 0xC:
-        num = int(m[-1], 0)
-    elif dt == 0x1:
-        num = round(int(m[-1], 0) / 10, 1)
-    elif dt == 0x2:
-        num = round(int(m[-1], 0) / 100, 2)
-    elif dt == 0x10:
-        num = (int(m[-2], 0) << 8) + int(m[-1], 0)
-    elif dt == 0x12:
-        num = round((int(m[-2], 0) << 8) + int(m[-1], 0) / 100, 2)
-    elif dt == 0x13:
-        num = round((int(m[-2], 0) << 8) + int(m[-1], 0) / 1000, 3)
-    elif dt == 0x14:
-        num = round((int(m[-2], 0) << 8) + int(m[-1], 0) / 10000, 4)
-    elif dt == 0x80:
-        num = int(m[-1], 0)
-        if num >= 128:
-            num -= 256
-    elif dt == 0x81:
-        num = int(m[-1], 0)
-        if num >= 128:
-            num -= 256
-        num = round(num / 10, 1)
-    elif dt == 0x82:
-        num = int(m[-1], 0)
-        if num >= 128:
-            num -= 256
-        num = round(num / 100, 2)
-    elif dt == 0x8F:
-        num = int(m[-1], 0)
-        if num >= 128:
-            num -= 256
-        num = round(num / 1000, 3)
-    elif dt == 0x90:
-        num = (int(m[-2], 0) << 8) + int(m[-1], 0)
-        if num >= 32768:
-            num -= 65536
-    elif dt == 0x91:
-        num = (int(m[-2], 0) << 8) + int(m[-1], 0)
-        if num >= 32768:
-            num -= 65536
-        num = round(num / 10, 2)
-    elif dt == 0x92:
-        num = (int(m[-2], 0) << 8) + int(m[-1], 0)
-        if num >= 32768:
-            num -= 65536
-        num = round(num / 100, 2)
-    elif dt == 0x20:
-        num = (int(m[-4], 0) << 24) + (int(m[-3], 0) << 16) + (int(m[-2], 0) << 8) + int(m[-1], 0)
-    else:
-        logger.error(f"Unknown datatype for '{name}': 0x{dt:X}")
-    return num
+
+def run_scheduled(wpu, steps, exporter=None, snapshot=None, store=None):
+    """
+    Run every step at its own interval with itho_scheduler, until interrupted.
+    """
+    from itho_scheduler import Scheduler, default_priority
+
+    scheduler = Scheduler()
+
+    def make_job(step):
+        def run():
+            if step.action == "getsettings" and not step.snapshot:
+                return iter_settings(wpu, step)
+            run_batch(wpu, [step], exporter, snapshot, store)
+            if wpu.cache is not None:
+                wpu.cache.flush()
+
+        return run
+
+    for step in steps:
+        scheduler.add(
+            step.action if step.id is None else f"{step.action} {step.id}",
+            make_job(step),
+            step.interval,
+            getattr(step, "priority", default_priority),
+            getattr(step, "deadline", None),
+        )
+    try:
+        scheduler.run()
+    finally:
+        for name, stats in scheduler.stats().items():
+            logger.debug(f"Schedule of {name}: {stats}")
+
+
+def run_daemon(wpu, steps, args, exporter=None, store=None):
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    snapshot = None
+    server = None
+    if args.metrics_port is not None:
+        from itho_metrics import MetricsServer, MetricsSnapshot
+
+        snapshot = MetricsSnapshot()
+        server = MetricsServer(snapshot, port=args.metrics_port)
+        server.start()
+    wpu.open()
+    try:
+        if args.schedule:
+            run_scheduled(wpu, steps, exporter, snapshot, store)
+        else:
+            while True:
+                started = time.monotonic()
+                run_batch(wpu, steps, exporter, snapshot, store)
+                if wpu.cache is not None:
+                    wpu.cache.flush()
+                if exporter is not None:
+                    logger.debug(f"InfluxDB export: {exporter.stats()}")
+                time.sleep(max(0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        logger.debug("Interrupted, stopping daemon")
+    finally:
+        wpu.close()
+        if server is not None:
+            server.close()
+
+
+# Defaults of the devices in a --devices file
+device_defaults = {
+    "name": None,
+    "bus": 1,
+    "master_address": 0x41,
+    "slave_address": 0x40,
+    "cache_file": None,
+    "sqlite_db": "heatpump.sqlite",
+    "emulate": None,
+}
+
+
+def read_devices(path):
+    """
+    Return the devices in a --devices file as a list of dicts, with the defaults filled in.
+    Addresses can be numbers or strings like "0x41".
+    """
+    with open(path) as f:
+        config = json.load(f)
+    devices = []
+    for device in config["devices"]:
+        device = {**device_defaults, **device}
+        for key in ["master_address", "slave_address"]:
+            if type(device[key]) is str:
+                device[key] = int(device[key], 0)
+        if device["name"] is None:
+            device["name"] = f"{device['bus']}-{device['master_address']:x}"
+        # The nodeid and serial aren't cached per device, every WPU needs its own cache file
+        if device["cache_file"] is None:
+            device["cache_file"] = f"itho-wpu-cache-{device['name']}.json"
+        for other in devices:
+            if other["name"] == device["name"]:
+                raise ValueError(f"Duplicate device name: {device['name']}")
+            if (other["bus"], other["master_address"]) == (
+                device["bus"],
+                device["master_address"],
+            ):
+                raise ValueError(f"{other['name']} and {device['name']} have the same address")
+        devices.append(device)
+    if not devices:
+        raise ValueError(f"No devices in {path}")
+    return devices
+
+
+def make_device_wpus(devices, args):
+    """
+    Create an IthoWPU for every device. Devices with the same database share its metadata, so
+    the metadata of a list version is loaded once.
+    """
+    from itho_metadata import HeatpumpMetadata
+
+    metadatas = {}  # sqlite_db: HeatpumpMetadata
+    for device in devices:
+        if device["sqlite_db"] not in metadatas:
+            metadatas[device["sqlite_db"]] = HeatpumpMetadata(device["sqlite_db"])
+        metadata = metadatas[device["sqlite_db"]]
+        transport = None
+        if device["emulate"] is not None:
+            from itho_emulator import EmulatedWPU
+
+            emulate = dict(device["emulate"])
+            index = metadata.get(emulate.pop("listversion"))
+            if index is None:
+                raise ValueError(f"Can't emulate {device['name']}")
+            transport = EmulatedWPU(index, **emulate)
+        device["wpu"] = IthoWPU(
+            args.master_only,
+            args.slave_only,
+            args.slave_timeout,
+            args.no_cache,
+            response_timeout=args.response_timeout,
+            transport=transport,
+            cache_file=device["cache_file"],
+            cache_ttls=json.loads(args.cache_ttl) if args.cache_ttl else None,
+            bus=device["bus"],
+            master_address=device["master_address"],
+            slave_address=device["slave_address"],
+            metadata=metadata,
+        )
+
+
+def get_json_result(result):
+    """
+    Return a result of run_action as something that can be written as JSON.
+    """
+    if isinstance(result, tuple):
+        return result._asdict()
+    if isinstance(result, list):
+        return [get_json_result(r) for r in result]
+    return result
+
+
+def poll_device(device, steps, exporter=None):
+    """
+    Execute the steps on a device and return its results, tagged with its name and serial.
+    """
+    wpu = device["wpu"]
+    output = {
+        "device": device["name"],
+        "serial": None,
+        "time": datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+        "results": {},
+    }
+    try:
+        wpu.open()
+        try:
+            if wpu.serial is not None:
+                output["serial"] = parse_serial(wpu.serial).serial
+            tags = {"device": device["name"]}
+            if output["serial"] is not None:
+                tags["serial"] = str(output["serial"])
+            results = run_batch(wpu, steps, exporter, tags=tags)
+        finally:
+            wpu.close()
+    except OSError as e:
+        logger.error(f"Polling {device['name']} failed: {e}")
+        return output
+    for step, result in results:
+        key = f"{step.action}:{step.id}" if step.action in id_actions else step.action
+        output["results"][key] = get_json_result(result)
+    if wpu.cache is not None:
+        wpu.cache.flush()
+    return output
+
+
+def run_devices(devices, steps, args, exporter=None):
+    """
+    Poll several devices, once or every --interval seconds with --daemon. The devices are
+    polled one after another, as they share the I2C slave (see itho_i2c.slave_lock). The
+    results are printed as one JSON line per device.
+    """
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            started = time.monotonic()
+            for device in devices:
+                output = poll_device(device, steps, exporter)
+                print(json.dumps(output), flush=True)
+            if not args.daemon:
+                break
+            if exporter is not None:
+                logger.debug(f"InfluxDB export: {exporter.stats()}")
+            time.sleep(max(0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        logger.debug("Interrupted, stopping daemon")
 
 
 def main():
     args = parse_args()
 
+    if args.profile is not None:
+        profiler.enable()
+        process_age = get_process_age()
+        if process_age is not None:
+            profiler.record("process_start", process_age)
+
     if args.loglevel:
         logger.setLevel(args.loglevel.upper())
         logging.getLogger("itho_i2c").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_decode").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_metadata").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_export").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_spool").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_metrics").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_store").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_transport").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_emulator").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_cache").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_snapshot").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_retry").setLevel(args.loglevel.upper())
+        logging.getLogger("itho_scheduler").setLevel(args.loglevel.upper())
+    elif args.devices:
+        # The results of all devices are printed as JSON lines instead
+        logger.setLevel(logging.WARNING)
 
     if args.timestamp:
         stdout_log_handler.setFormatter(
             logging.Formatter("%(asctime)-15s %(levelname)s: %(message)s")
         )
 
-    if args.action in ["getsetting", "setsetting", "getmanual", "setmanual"] and args.id is None:
-        logger.error(f"`--id` is required with `--action {args.action}`")
+    try:
+        steps = get_steps(args)
+    except (OSError, ValueError, TypeError) as e:
+        logger.error(f"Invalid plan: {e}")
         return
 
-    wpu = IthoWPU(args.master_only, args.slave_only, args.slave_timeout, args.no_cache)
+    for step in steps:
+        needs_id = step.action in id_actions
+        if needs_id and step.id is None:
+            logger.error(f"`--id` is required with `--action {step.action}`")
+            return
 
-    if args.action == "getsettings":
-        process_settings(wpu, args)
+    changes_settings = any(step.action in ["setsetting", "setmanual"] for step in steps)
+    if args.daemon and (changes_settings or args.slave_only):
+        logger.error("`--daemon` can't be used with `--slave-only` or to change settings")
         return
 
-    if args.action == "setsetting":
-        process_setsetting(wpu, args)
+    if args.settings_slice is not None and not args.snapshot:
+        logger.error("`--settings-slice` requires `--snapshot`")
         return
 
-    if args.action == "setmanual":
-        process_setmanual(wpu, args)
+    if args.metrics_port is not None and not args.daemon:
+        logger.error("`--metrics-port` requires `--daemon`")
         return
 
-    response = wpu.call(args.action, args.id)
-    if response is not None:
-        process_response(args.action, response, args, wpu)
+    if args.schedule and (not args.daemon or args.devices):
+        logger.error("`--schedule` requires `--daemon` and can't be used with `--devices`")
+        return
+
+    if args.emulate is not None and args.replay:
+        logger.error("`--emulate` can't be used with `--replay`")
+        return
+
+    per_wpu_options = [
+        args.store_dir,
+        args.metrics_port,
+        args.deadband or None,
+        args.deadband_config,
+        args.snapshot,
+        args.emulate,
+        args.replay,
+        args.record,
+    ]
+    if args.devices and (changes_settings or any(o is not None for o in per_wpu_options)):
+        logger.error(
+            "`--devices` can't be used to change settings or with `--store-dir`, "
+            "`--metrics-port`, `--deadband`, `--snapshot`, `--emulate`, `--replay` or `--record`"
+        )
+        return
+
+    emulator = None
+    if args.devices:
+        try:
+            devices = read_devices(args.devices)
+            make_device_wpus(devices, args)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Invalid devices file: {e}")
+            return
+        wpus = [device["wpu"] for device in devices]
+    else:
+        transport = None
+        if args.emulate is not None:
+            from itho_emulator import EmulatedWPU
+            from itho_metadata import HeatpumpMetadata
+
+            metadata = HeatpumpMetadata("heatpump.sqlite").get(args.emulate)
+            if metadata is None:
+                return
+            faults = json.loads(args.emulate_faults) if args.emulate_faults else {}
+            emulator = EmulatedWPU(metadata, delay=args.emulate_delay, **faults)
+            transport = emulator
+        if args.replay:
+            from itho_transport import ReplayTransport
+
+            transport = ReplayTransport(args.replay, args.replay_speed)
+        if args.record:
+            from itho_transport import RecordingTransport
+
+            if transport is None:
+                transport = I2CBus(master=not args.master_only, slave=not args.slave_only)
+            transport = RecordingTransport(transport, args.record)
+
+        wpu = IthoWPU(
+            args.master_only,
+            args.slave_only,
+            args.slave_timeout,
+            args.no_cache,
+            response_timeout=args.response_timeout,
+            transport=transport,
+            cache_file=args.cache_file,
+            cache_ttls=json.loads(args.cache_ttl) if args.cache_ttl else None,
+        )
+        wpus = [wpu]
+
+    exporter = None
+    if args.export_to_influxdb:
+        from itho_export import InfluxDBExporter
+
+        spool = None
+        if args.spool_dir:
+            from itho_spool import Spool
+
+            spool = Spool(args.spool_dir, max_bytes=args.spool_max_mb * 1_000_000)
+        deadband = None
+        if args.deadband or args.deadband_config:
+            from itho_export import DeadbandFilter
+
+            rules = None
+            if args.deadband_config:
+                with open(args.deadband_config) as f:
+                    rules = json.load(f)
+            deadband = DeadbandFilter(
+                rules, args.heartbeat, defaults=lambda: get_deadband_defaults(wpu)
+            )
+        exporter = InfluxDBExporter(spool=spool, deadband=deadband)
+        exporter.start()
+
+    store = None
+    if args.store_dir:
+        from itho_store import DatalogStore
+
+        store = DatalogStore(args.store_dir)
+
+    try:
+        if args.devices:
+            run_devices(devices, steps, args, exporter)
+        elif args.daemon:
+            run_daemon(wpu, steps, args, exporter, store)
+        else:
+            run_batch(wpu, steps, exporter, store=store)
+    finally:
+        for wpu in wpus:
+            if wpu.cache is not None:
+                wpu.cache.flush()
+            for action, policy in wpu.policies.policies.items():
+                logger.debug(f"Retry policy of {action}: {policy.stats()}")
+        if emulator is not None:
+            logger.debug(f"Emulated WPU: {emulator.stats}")
+        if exporter is not None:
+            exporter.close()
+        if store is not None:
+            store.close()
+        if args.profile == "-":
+            print(profiler.report())
+        elif args.profile is not None:
+            with open(args.profile, "w") as f:
+                json.dump(profiler.to_dict(), f, indent=2)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import logging
+import sys
+import time
+from itho_i2c import (
+    I2CBus,
+    I2CMaster,
+    actions,
+    default_response_timeout,
+    get_response_key,
+)
+from itho_profile import profiler
+from itho_retry import NACK, REJECTED, SILENCE, SUCCESS, CircuitBreaker, RetryLoop, RetryPolicies
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+
+class FutureQueue:
+    """
+    Passed to a transport instead of a queue.Queue. Responses put by the transport, from the
+    pigpio callback or another thread, resolve the future of the matching request in the event
+    loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.futures = {}  # response key: future
+
+    def put(self, item, block=True, timeout=None):
+        self.loop.call_soon_threadsafe(self._resolve, bytes(item))
+
+    def _resolve(self, response):
+        future = self.futures.get(get_response_key(response))
+        if future is None or future.done():
+            logger.debug(f"Discarding unexpected response: {response.hex(' ')}")
+            return
+        future.set_result(response)
+
+
+class AsyncIthoWPU:
+    """
+    asyncio client of the WPU. `await wpu.call("getdatalog")` returns as soon as the transport
+    receives the response, without blocking the event loop or a thread.
+
+    Requests for different settings or manual operations can be in flight at the same time,
+    requests with the same message class and identifier wait for each other. Responses are
+    returned as bytes, like IthoWPU.call. There is no cache and setsetting and setmanual don't
+    ask for confirmation.
+
+        wpu = AsyncIthoWPU()
+        await wpu.open()
+        response = await wpu.call("getdatalog")
+        await wpu.close()
+    """
+
+    def __init__(
+        self, transport=None, response_timeout=default_response_timeout, response_timeouts=None
+    ):
+        self.transport = transport if transport is not None else I2CBus()
+        self.response_timeout = response_timeout
+        self.response_timeouts = response_timeouts if response_timeouts is not None else {}
+        self.policies = RetryPolicies(response_timeout, response_timeouts)
+        self.breaker = CircuitBreaker()
+        # Round-trip times in seconds of the most recent requests
+        self.latencies = collections.deque(maxlen=100)
+        self._queue = None
+        self._master = None
+        self._locks = {}  # response key: asyncio.Lock
+        self._open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self):
+        return self._queue is not None
+
+    async def open(self):
+        if self.is_open:
+            return
+        async with self._open_lock:
+            if self.is_open:
+                return
+            loop = asyncio.get_running_loop()
+            queue = FutureQueue(loop)
+            with profiler.stage("transport_open"):
+                # I2CBus.open waits for the slave lock, which would block the event loop
+                await loop.run_in_executor(None, self.transport.open, queue)
+            # Only used to compose requests and write them to the transport
+            self._master = I2CMaster(
+                address=0x41,
+                bus=1,
+                queue=None,
+                timeout=self.response_timeout,
+                transport=self.transport,
+            )
+            self._queue = queue
+
+    async def close(self):
+        if not self.is_open:
+            return
+        for future in self._queue.futures.values():
+            future.cancel()
+        self.transport.close()
+        self._queue = None
+        self._master = None
+
+    async def call(self, action, identifier=None, datatype=None, value=None, check=True):
+        """
+        Execute an action and return the response, or None when no valid response was received
+        within the attempts of the retry policy of the action (see itho_retry.RetryPolicy).
+        """
+        await self.open()
+        request = self._master.compose_request(action, identifier, datatype, value, check)
+        key = (bytes(actions[action]), identifier)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            return await self._execute(action, request, key)
+
+    async def _execute(self, action, request, key):
+        logger.debug(f"Request: {bytes(request).hex(' ')}")
+        response = None
+        future = asyncio.get_running_loop().create_future()
+        futures = self._queue.futures
+        futures[key] = future
+        loop = RetryLoop(action, self.policies.get(action), self.breaker)
+        try:
+            for backoff in loop:
+                await asyncio.sleep(backoff)
+                logger.debug(f"Executing action: {action}")
+                rejected = getattr(self.transport, "rejected", 0)
+                if not self._master.write_request(request):
+                    loop.record(NACK)
+                    continue
+                sent = time.monotonic()
+                try:
+                    # shield() keeps the future when the timeout expires, a late response to
+                    # the previous attempt is as good as a response to the next one
+                    response = await asyncio.wait_for(asyncio.shield(future), loop.timeout)
+                except asyncio.TimeoutError:
+                    profiler.count("timeouts")
+                    if action == "setmanual":
+                        return None
+                    silence = getattr(self.transport, "rejected", 0) == rejected
+                    loop.record(SILENCE if silence else REJECTED)
+                    continue
+                latency = time.monotonic() - sent
+                profiler.record("wait_response", latency)
+                self.latencies.append(latency)
+                loop.record(SUCCESS, latency)
+                logger.debug(f"Response: {response.hex(' ')}")
+                break
+        finally:
+            del futures[key]
+        loop.finish(response is not None)
+        return response
+
+    async def call_many(self, action, identifiers, depth=4):
+        """
+        Execute a read action for many identifiers with up to `depth` requests in flight.
+        Returns a dict of identifier: response.
+        """
+        semaphore = asyncio.Semaphore(depth)
+
+        async def call(identifier):
+            async with semaphore:
+                return identifier, await self.call(action, identifier)
+
+        return dict(await asyncio.gather(*(call(identifier) for identifier in identifiers)))
@@ -0,0 +1,205 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import sys
+import time
+from itho_profile import profiler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+schema_version = "3"
+
+# Seconds an entry is valid, by the part of the key before ":". None never expires, 0 disables
+# caching. The nodeid and serial that identify the device expire, so a replaced controller or a
+# firmware update (a new list version) is noticed within a day, or as soon as a datalog doesn't
+# match the cached datatype. Values that change, like settings and counters, aren't cached
+# unless a TTL is given.
+default_ttls = {
+    "nodeid": 86400,
+    "serial": 86400,
+    "datatype": None,
+    "datalog_decoder": None,
+    "counters": 0,
+    "setting": 0,
+    "manual": 0,
+}
+
+# Keys that belong to the WPU and not to a device (serial and nodeid) of it
+global_keys = ["nodeid", "serial", "datalog_decoder"]
+
+
+def get_cache_key(action, identifier=None):
+    """
+    Return the cache key of the response to an action, or None when it isn't cached.
+    """
+    if action in ["getnodeid", "getserial", "getdatatype", "getcounters"]:
+        return action.replace("get", "")
+    if action in ["getsetting", "setsetting"]:
+        return f"setting:{identifier}"
+    if action in ["getmanual", "setmanual"]:
+        return f"manual:{identifier}"
+    return None
+
+
+def get_device_key(serial, nodeid):
+    """
+    Identify a device by its getserial and getnodeid responses.
+    """
+    number = (serial[5] << 16) + (serial[6] << 8) + serial[7]
+    return f"{number}-{bytes(nodeid[5:-1]).hex()}"
+
+
+class IthoWPUCache:
+    """
+    Persistent cache of responses and other slowly changing results, stored as JSON in
+    `cache_file`.
+
+    Entries expire after the TTL of their key (see default_ttls). Entries of a device are
+    stored under its device key, built from the serial and nodeid of the WPU, so entries of a
+    replaced controller aren't used once its nodeid and serial have been read again.
+
+    Changes are kept in memory and written at once by `flush`, which is also called at exit.
+    The file is locked while it is written, changes of concurrent runs are merged and the file
+    is replaced atomically, so it is never left half-written.
+    """
+
+    def __init__(self, cache_file="itho-wpu-cache.json", ttls=None):
+        self.cache_file = cache_file
+        self.ttls = dict(default_ttls)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self._changes = {}  # (device, key): entry, or None when invalidated
+        with profiler.stage("cache_load"):
+            self._data = self._read()
+        atexit.register(self.flush)
+
+    def _read(self):
+        data = {"schema_version": schema_version, "entries": {}, "devices": {}}
+        try:
+            with open(self.cache_file) as f:
+                cache_data = json.load(f)
+        except FileNotFoundError:
+            logger.debug(f"Not loading cache file: {self.cache_file} does not exist")
+            return data
+        except ValueError as e:
+            logger.warning(f"Ignoring invalid cache file {self.cache_file}: {e}")
+            return data
+        logger.debug(f"Loading local cache: {self.cache_file}")
+        if cache_data.get("schema_version") == schema_version:
+            return cache_data
+        return self._migrate(cache_data, data)
+
+    def _migrate(self, cache_data, data):
+        # schema_version 1 stored a list of hexadecimal strings per response, 2 a hexadecimal
+        # string, both without expiry or device
+        frames = {}
+        for key in ["nodeid", "serial", "datatype"]:
+            value = cache_data.get(key)
+            if type(value) is list:
+                frames[key] = bytes(int(c, 0) for c in value)
+            elif value is not None:
+                frames[key] = bytes.fromhex(value)
+        for key, frame in frames.items():
+            if key in global_keys:
+                data["entries"][key] = self._make_entry(key, frame)
+        if "datatype" in frames and "serial" in frames and "nodeid" in frames:
+            device = get_device_key(frames["serial"], frames["nodeid"])
+            entry = self._make_entry("datatype", frames["datatype"])
+            data["devices"][device] = {"datatype": entry}
+        if cache_data.get("datalog_decoder") is not None:
+            entry = self._make_entry("datalog_decoder", cache_data["datalog_decoder"])
+            data["entries"]["datalog_decoder"] = entry
+        return data
+
+    def get_ttl(self, key):
+        return self.ttls.get(key.split(":")[0])
+
+    def _make_entry(self, key, value):
+        ttl = self.get_ttl(key)
+        entry = {"expires": None if ttl is None else time.time() + ttl}
+        if type(value) is bytes:
+            entry["frame"] = value.hex()
+        else:
+            entry["value"] = value
+        return entry
+
+    def _get_entries(self, data, device):
+        if device is None:
+            return data["entries"]
+        return data["devices"].setdefault(device, {})
+
+    def get(self, key, device=None, expired=False):
+        """
+        Return the cached value of `key`, or None when it isn't cached or expired.
+
+        :param device: Device key (see get_device_key), None for keys in global_keys
+        :param expired: Also return an expired value
+        """
+        if (device, key) in self._changes:
+            entry = self._changes[(device, key)]
+        elif device is None:
+            entry = self._data["entries"].get(key)
+        else:
+            entry = self._data["devices"].get(device, {}).get(key)
+        if entry is None:
+            logger.debug(f"'{key}' is not present in local cache")
+            return None
+        if not expired and entry["expires"] is not None and entry["expires"] < time.time():
+            logger.debug(f"'{key}' in local cache is expired")
+            return None
+        logger.debug(f"Reading '{key}' from local cache")
+        if "frame" in entry:
+            return bytes.fromhex(entry["frame"])
+        return entry["value"]
+
+    def set(self, key, value, device=None):
+        """
+        Cache a value: a response (bytes) or anything that can be stored as JSON.
+        """
+        if self.get_ttl(key) == 0:
+            return
+        logger.debug(f"Writing '{key}' to local cache")
+        self._changes[(device, key)] = self._make_entry(key, value)
+
+    def invalidate(self, key, device=None):
+        logger.debug(f"Invalidating '{key}' in local cache")
+        self._changes[(device, key)] = None
+
+    def flush(self):
+        """
+        Write the changes to the cache file.
+        """
+        if not self._changes:
+            return
+        with profiler.stage("cache_write"), open(self.cache_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Merge with the changes of runs that flushed after this one started
+            data = self._read()
+            for (device, key), entry in self._changes.items():
+                entries = self._get_entries(data, device)
+                if entry is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = entry
+            # Expired entries of devices are removed, and devices without entries
+            now = time.time()
+            for entries in data["devices"].values():
+                for key, entry in list(entries.items()):
+                    if entry["expires"] is not None and entry["expires"] < now:
+                        del entries[key]
+            data["devices"] = {device: e for device, e in data["devices"].items() if e}
+
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.cache_file)
+        self._data = data
+        self._changes = {}
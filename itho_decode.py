@@ -0,0 +1,252 @@
+import logging
+import struct
+import sys
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+# datatype: (size in bytes, signed, divisor, decimals)
+datatypes = {
+    0x0: (1, False, 1, None),
+    0x1: (1, False, 10, 1),
+    0x2: (1, False, 100, 2),
+    0xC: (1, False, 1, None),
+    0x10: (2, False, 1, None),
+    0x12: (2, False, 100, 2),
+    0x13: (2, False, 1000, 3),
+    0x14: (2, False, 10000, 4),
+    0x80: (1, True, 1, None),
+    0x81: (1, True, 10, 1),
+    0x82: (1, True, 100, 2),
+    0x8F: (1, True, 1000, 3),
+    0x90: (2, True, 1, None),
+    0x91: (2, True, 10, 2),
+    0x92: (2, True, 100, 2),
+    0x20: (4, False, 1, None),
+}
+
+# Datatypes with a known size, but without a known way to decode them
+unknown_datatype_sizes = {
+    0xF: 1,
+    0x6C: 1,
+    0x11: 2,
+    0x51: 2,
+    0x21: 4,
+    0x22: 4,
+    0x23: 4,
+    0x24: 4,
+    0x25: 4,
+    0xA0: 4,
+    0xA1: 4,
+    0xA2: 4,
+    0xA3: 4,
+    0xA4: 4,
+    0xA5: 4,
+}
+
+# struct format character: NumPy type (without byte order)
+numpy_types = {
+    "B": "u1",
+    "b": "i1",
+    "H": "u2",
+    "h": "i2",
+    "I": "u4",
+    "i": "i4",
+}
+
+struct_formats = {
+    (1, False): "B",
+    (1, True): "b",
+    (2, False): "H",
+    (2, True): "h",
+    (4, False): "I",
+    (4, True): "i",
+}
+
+
+def get_datatype_size(dt):
+    if dt in datatypes:
+        return datatypes[dt][0]
+    return unknown_datatype_sizes.get(dt)
+
+
+Field = namedtuple("Field", "index type label description")
+
+
+def get_datalog_structure(datatype, datalabel):
+    """
+    Derive the datalog structure from the getdatatype response of the WPU and the datalabels
+    of its list version: the offset, datatype, label and description of every field.
+    """
+    if len(datatype[5:-1]) != len(datalabel):
+        logger.warning(
+            f"Number of datatype items ({len(datatype[5:-1])}) is not equal to "
+            f"the number of datalabels ({len(datalabel)}) in the database."
+        )
+
+    datalog = []
+    index = 0
+    for dl, dt in zip(datalabel, datatype[5:-1]):
+        description = dl["title"].title()
+        if dl["unit"] is not None:
+            description = f"{description} ({dl['unit']})"
+        description = f"{description} ({dl['name'].lower()})"
+
+        size = get_datatype_size(dt)
+        if size is None:
+            # The offset of the following fields is unknown as well
+            logger.error(f"Unknown data type for label {dl['name']}: {dt}")
+            return datalog
+        datalog.append(Field(index, dt, dl["name"].lower(), description))
+        index = index + size
+    return datalog
+
+
+def make_converter(dt):
+    """
+    Return a function that scales a raw integer of datatype `dt`, or None when the raw
+    integer is the value. The arithmetic is the same as `format_datatype`.
+    """
+    _, _, divisor, decimals = datatypes[dt]
+    if divisor == 1:
+        return None
+    if dt in [0x12, 0x13, 0x14]:
+        # format_datatype only scales the least significant byte of these datatypes
+        return lambda raw: round((raw & 0xFF00) + (raw & 0xFF) / divisor, decimals)
+    return lambda raw: round(raw / divisor, decimals)
+
+
+def scale_array(np, raw, dt):
+    """
+    Vectorized `make_converter`: scale a NumPy array of raw integers of datatype `dt`.
+    Values of unknown datatypes become NaN.
+    """
+    if dt not in datatypes:
+        return np.full(raw.shape, np.nan)
+    _, _, divisor, decimals = datatypes[dt]
+    if divisor == 1:
+        return raw
+    if dt in [0x12, 0x13, 0x14]:
+        raw = raw.astype(np.int64)
+        return np.round((raw & 0xFF00) + (raw & 0xFF) / divisor, decimals)
+    return np.round(raw / divisor, decimals)
+
+
+class DatalogDecoder:
+    """
+    Decoder for datalog responses, compiled once from the datalog structure into a single
+    struct format and a list of per field converters.
+    """
+
+    def __init__(self, fields):
+        self.fields = [tuple(f) for f in fields]
+        self.labels = [f[2] for f in self.fields]
+        self.descriptions = [f[3] for f in self.fields]
+
+        fmt = ">"
+        self._plan = []
+        self.codes = []  # struct format character of each field
+        offset = 0
+        for index, dt, label, _ in self.fields:
+            if index > offset:
+                fmt += f"{index - offset}x"
+                offset = index
+            if dt in datatypes:
+                size, signed = datatypes[dt][0:2]
+                self.codes.append(struct_formats[(size, signed)])
+                self._plan.append((label, make_converter(dt)))
+            else:
+                size = unknown_datatype_sizes[dt]
+                self.codes.append(struct_formats[(size, False)])
+                self._plan.append((label, lambda raw: None))
+                logger.error(f"Unknown datatype for '{label}': 0x{dt:X}")
+            fmt += self.codes[-1]
+            offset += size
+        self._struct = struct.Struct(fmt)
+
+    @staticmethod
+    def fingerprint(listversion, datatype):
+        """
+        Identify a datalog structure by the list version of the WPU and its getdatatype
+        response. The response is used as is, hashing it would cost more (importing hashlib)
+        than it saves.
+        """
+        return f"{listversion}-{bytes(datatype).hex()}"
+
+    def to_dict(self):
+        return {"fields": [list(f) for f in self.fields]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["fields"])
+
+    def decode(self, message):
+        """
+        Decode the message of a datalog response (the response without its header) into
+        a dict of label: value.
+
+        :param bytes message: Datalog message
+        """
+        values = self.decode_values(message)
+        if values is None:
+            return None
+        return dict(zip(self.labels, values))
+
+    def decode_values(self, message):
+        """
+        Decode the message of a datalog response into a list of values, one for each field,
+        also when labels repeat.
+
+        :param bytes message: Datalog message
+        """
+        if len(message) < self._struct.size:
+            logger.error(
+                f"Datalog message is too short ({len(message)} < {self._struct.size} bytes)"
+            )
+            return None
+        return [
+            raw if convert is None else convert(raw)
+            for (_, convert), raw in zip(self._plan, self._struct.unpack_from(message))
+        ]
+
+    def decode_raw(self, message):
+        """
+        Decode the message of a datalog response into a tuple of unscaled integers, one for
+        each field.
+        """
+        if len(message) < self._struct.size:
+            logger.error(
+                f"Datalog message is too short ({len(message)} < {self._struct.size} bytes)"
+            )
+            return None
+        return self._struct.unpack_from(message)
+
+    @property
+    def size(self):
+        return self._struct.size
+
+    def numpy_dtype(self, np):
+        """
+        NumPy structured dtype of a datalog message, with one field (f0, f1, ...) per datalabel.
+        """
+        return np.dtype(
+            {
+                "names": [f"f{i}" for i in range(len(self.fields))],
+                "formats": [f">{numpy_types[code]}" for code in self.codes],
+                "offsets": [f[0] for f in self.fields],
+                "itemsize": self.size,
+            }
+        )
+
+    def decode_many(self, np, messages):
+        """
+        Decode many datalog messages at once into a dict of label: NumPy array of values.
+
+        :param messages: 2-D uint8 array with one message of `size` bytes per row
+        """
+        raw = np.ascontiguousarray(messages).view(self.numpy_dtype(np)).reshape(-1)
+        return {f[2]: scale_array(np, raw[f"f{i}"], f[1]) for i, f in enumerate(self.fields)}
@@ -0,0 +1,221 @@
+import logging
+import random
+import sys
+import time
+from itho_decode import get_datatype_size
+from itho_i2c import actions, is_checksum_valid, is_length_valid
+from itho_profile import profiler
+from itho_transport import DelayedDelivery
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+# unit: datatype of emulated datalabels, other units are unsigned 16-bit integers
+datalabel_datatypes = {
+    "°C": 0x92,
+    "K": 0x92,
+    "bar": 0x92,
+    "%": 0x0,
+}
+
+
+def make_frame(message_class, payload):
+    """
+    Compose a response frame of the WPU with a valid length and checksum.
+    """
+    frame = bytes([0x82]) + bytes(message_class) + bytes([0x01, len(payload)]) + bytes(payload)
+    return frame + bytes([(256 - (0x80 + sum(frame)) % 256) % 256])
+
+
+def choose_datatype(minimum, maximum):
+    """
+    Return the datatype and number of decimals of a setting or manual operation that can hold
+    all values between minimum and maximum.
+    """
+    values = [v for v in [minimum, maximum] if v is not None]
+    if all(float(v).is_integer() for v in values):
+        if any(v < 0 for v in values):
+            return 0x90, 0
+        return (0x10, 0) if max(values, default=0) < 65536 else (0x20, 0)
+    if all(float(v * 10).is_integer() for v in values):
+        return 0x91, 1
+    return 0x92, 2
+
+
+def to_raw(value, decimals, size):
+    return (round(value * 10**decimals) % (1 << (8 * size))).to_bytes(size, byteorder="big")
+
+
+class EmulatedWPU:
+    """
+    Transport that emulates a WPU of list version `metadata.listversion` (a MetadataIndex),
+    to test and benchmark without a heat pump.
+
+    All actions are answered with frames generated from the metadata. Datalog values and
+    counters change over time, settings and manual operations can be changed. Settings and
+    manual operations start at their default value.
+
+    Responses are sent after `delay` seconds, plus a random `jitter`. Faults are injected with
+    the given probabilities: `drop` sends no response, `corrupt` sends a response with an
+    invalid checksum and `wrong_length` a response with an invalid length. Like the I2C slave,
+    invalid responses are rejected and never put on the queue.
+    """
+
+    def __init__(
+        self,
+        metadata,
+        serial=1,
+        delay=0.02,
+        jitter=0,
+        drop=0,
+        corrupt=0,
+        wrong_length=0,
+        seed=None,
+    ):
+        self.metadata = metadata
+        self.serial = serial
+        self.delay = delay
+        self.jitter = jitter
+        self.drop = drop
+        self.corrupt = corrupt
+        self.wrong_length = wrong_length
+        self.stats = {
+            "requests": 0,
+            "invalid_requests": 0,
+            "responses": 0,
+            "dropped": 0,
+            "rejected": 0,
+        }
+        self._random = random.Random(seed)
+        self._delivery = DelayedDelivery()
+        self._started = time.monotonic()
+
+        self._datatypes = [
+            datalabel_datatypes.get(dl["unit"], 0x10) for dl in metadata.datalabels or []
+        ]
+        self._datalog = [
+            self._random.randrange(1000, 3000) if get_datatype_size(dt) > 1 else 50
+            for dt in self._datatypes
+        ]
+        self._settings = {}  # id: [datatype, decimals, value, minimum, maximum]
+        for settingid, setting in (metadata.settings or {}).items():
+            minimum = setting["min"] or 0
+            maximum = setting["max"] if setting["max"] is not None else minimum
+            datatype, decimals = choose_datatype(minimum, maximum)
+            value = setting["def"] if setting["def"] is not None else minimum
+            self._settings[settingid] = [datatype, decimals, value, minimum, maximum]
+        self._manuals = {}  # id: [datatype, decimals, value]
+        for manualid, manual in (metadata.manuals or {}).items():
+            datatype, decimals = choose_datatype(manual["min"], manual["max"])
+            if datatype == 0x20:
+                datatype = 0x10
+            self._manuals[manualid] = [datatype, decimals, manual["def"] or 0]
+
+    def open(self, queue):
+        self._delivery.open(queue)
+
+    @property
+    def rejected(self):
+        return self.stats["rejected"]
+
+    def write_i2c_block_data(self, data):
+        request = bytes(data)
+        self.stats["requests"] += 1
+        if (0x82 + sum(request)) % 256 != 0 or len(request) < 6:
+            logger.debug(f"Invalid request: {request.hex(' ')}")
+            self.stats["invalid_requests"] += 1
+            return 0
+        response = self.respond(request)
+        if response is None:
+            return 0
+        if self._random.random() < self.drop:
+            self.stats["dropped"] += 1
+            return 0
+        if self._random.random() < self.corrupt:
+            response = response[:-1] + bytes([(response[-1] + 1) % 256])
+        if self._random.random() < self.wrong_length:
+            response = response[:-2] + response[-1:]
+        with profiler.stage("validate"):
+            valid = is_checksum_valid(response) and is_length_valid(response)
+        if not valid:
+            self.stats["rejected"] += 1
+            profiler.count("invalid_responses")
+            return 0
+        self.stats["responses"] += 1
+        self._delivery.put(response, self.delay + self._random.uniform(0, self.jitter))
+        return 0
+
+    def respond(self, request):
+        """
+        Return the response frame to a request, or None when the WPU doesn't answer it.
+        """
+        message_class = list(request[1:3])
+        payload = request[5:-1]
+        write = request[3] == 0x06
+        if message_class == actions["getnodeid"]:
+            return make_frame(message_class, [0x00, 0x01, 0x00, 13, 25, self.metadata.listversion])
+        if message_class == actions["getserial"]:
+            return make_frame(message_class, self.serial.to_bytes(3, byteorder="big"))
+        if message_class == actions["getdatatype"]:
+            return make_frame(message_class, self._datatypes)
+        if message_class == actions["getdatalog"]:
+            return make_frame(message_class, self._get_datalog())
+        if message_class == actions["getcounters"]:
+            hours = int((time.monotonic() - self._started) / 3600)
+            counters = self.metadata.counters or []
+            length = max([int(c["id"]) + 1 for c in counters], default=0)
+            return make_frame(
+                message_class, b"".join(hours.to_bytes(2, "big") for _ in range(length))
+            )
+        if message_class == actions["getsetting"] and len(payload) == 19:
+            return self._setting_response(message_class, payload, write)
+        if message_class == actions["getmanual"] and len(payload) >= 4:
+            return self._manual_response(message_class, payload, write)
+        return None
+
+    def _get_datalog(self):
+        message = b""
+        for i, datatype in enumerate(self._datatypes):
+            size = get_datatype_size(datatype)
+            value = self._datalog[i] + self._random.randint(-5, 5)
+            self._datalog[i] = min(max(0, value), (1 << (8 * size)) - 1)
+            message += self._datalog[i].to_bytes(size, byteorder="big")
+        return message
+
+    def _setting_response(self, message_class, payload, write):
+        settingid = payload[17]
+        setting = self._settings.get(settingid)
+        if setting is None:
+            return None
+        datatype, decimals, value, minimum, maximum = setting
+        if write:
+            new = int.from_bytes(payload[0:4], byteorder="big") / 10**decimals
+            if minimum <= new <= maximum:
+                setting[2] = value = new
+        return make_frame(
+            message_class,
+            to_raw(value, decimals, 4)
+            + to_raw(minimum, decimals, 4)
+            + to_raw(maximum, decimals, 4)
+            + to_raw(1 / 10**decimals, decimals, 4)
+            + bytes([datatype, settingid, 0x00]),
+        )
+
+    def _manual_response(self, message_class, payload, write):
+        manualid = int.from_bytes(payload[1:3], byteorder="big")
+        manual = self._manuals.get(manualid)
+        if manual is None:
+            return None
+        datatype, decimals, value = manual
+        if write and len(payload) >= 6:
+            manual[2] = value = int.from_bytes(payload[4:6], byteorder="big") / 10**decimals
+        return make_frame(
+            message_class,
+            bytes(payload[0:3]) + bytes([datatype]) + to_raw(value, decimals, 2),
+        )
+
+    def close(self):
+        self._delivery.close()
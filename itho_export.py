@@ -1,25 +1,305 @@
+import collections
 import datetime
+import logging
 import os
+import queue
+import sys
+import threading
+import time
+from itho_profile import profiler
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
 
-def export_to_influxdb(action, measurements):
+
+# unit: minimal change of a value before it is exported again
+default_deadbands = {
+    "°C": 0.2,
+    "K": 0.2,
+    "%": 1,
+    "bar": 0.05,
+}
+
+
+def get_default_deadband(unit, dt):
+    """
+    Return the default deadband for a datalabel: the deadband of its unit, but at least the
+    resolution of its datatype. Without a deadband for the unit every change is exported.
+    """
+    from itho_decode import datatypes
+
+    resolution = 1 / datatypes[dt][2] if dt in datatypes else 0
+    return max(default_deadbands.get(unit, 0), resolution)
+
+
+class DeadbandFilter:
+    """
+    Only pass on fields that changed by at least their deadband since they were last passed
+    on, or that weren't passed on for `heartbeat` seconds. Fields are identified by their
+    action and label, so a counter and a datalabel with the same name are filtered apart.
+
+    `rules` is a dict of label: {"deadband": ..., "heartbeat": ...} that overrides the defaults,
+    where a label is a datalabel or "action:label" for the fields of other actions, e.g.
+    "getcounters:...". `defaults` is called once, on the first call of `filter`, and returns a
+    dict of (action, label): deadband.
+    """
+
+    def __init__(self, rules=None, heartbeat=300, defaults=None):
+        self.rules = {}  # (action, label): rule
+        for key, rule in (rules or {}).items():
+            action, _, label = key.rpartition(":")
+            self.rules[(action or "getdatalog", label)] = rule
+        self.heartbeat = heartbeat
+        self._defaults = defaults
+        self._deadbands = None
+        self._last = {}  # (action, label): (value, time passed on)
+
+    def filter(self, action, measurements, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self._deadbands is None:
+            self._deadbands = self._defaults() if self._defaults is not None else {}
+        changed = {}
+        for label, value in measurements.items():
+            if value is None:
+                continue
+            key = (action, label)
+            rule = self.rules.get(key, {})
+            last = self._last.get(key)
+            if last is not None:
+                deadband = rule.get("deadband", self._deadbands.get(key, 0))
+                heartbeat = rule.get("heartbeat", self.heartbeat)
+                difference = abs(value - last[0])
+                # Allow for rounding errors, 20.2 - 20.0 is slightly less than 0.2
+                moved = difference > 0 and difference >= deadband - 1e-9
+                if not moved and now - last[1] < heartbeat:
+                    continue
+            changed[label] = value
+            self._last[key] = (value, now)
+        return changed
+
+
+def make_influxdb_client():
     from influxdb import InfluxDBClient
 
-    influx_client = InfluxDBClient(
+    return InfluxDBClient(
         host=os.getenv("INFLUXDB_HOST", "localhost"),
         port=os.getenv("INFLUXDB_PORT", 8086),
         username=os.getenv("INFLUXDB_USERNAME", "root"),
         password=os.getenv("INFLUXDB_PASSWORD", "root"),
         database=os.getenv("INFLUXDB_DATABASE"),
     )
-    json_body = [
-        {
-            "measurement": action,
-            "time": datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
-            "fields": measurements,
+
+
+def make_point(action, measurements, timestamp=None, tags=None):
+    if timestamp is None:
+        timestamp = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+    point = {
+        "measurement": action,
+        "time": timestamp,
+        "fields": measurements,
+    }
+    if tags:
+        point["tags"] = tags
+    return point
+
+
+class InfluxDBExporter:
+    """
+    Export points to InfluxDB from a background thread, so a slow or unreachable InfluxDB
+    never blocks polling the WPU.
+
+    Points are buffered in a bounded queue and written in batches of `batch_size` points, or
+    when the oldest buffered point is `max_age` seconds old. One client (and its keep-alive
+    HTTP connection) is used for all writes. When the buffer is full the oldest points are
+    dropped. A failed batch is kept and written again after an increasing delay.
+
+    With a `spool` (see itho_spool) every point is appended to the spool first, instead of the
+    in-memory queue. Spooled points are written in batches and survive an unreachable
+    InfluxDB and restarts.
+
+    With a `deadband` (DeadbandFilter) only changed fields are exported.
+
+    Any object with a `write_points(points)` method can be used as client.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        batch_size=100,
+        max_age=10,
+        max_buffer=10000,
+        spool=None,
+        deadband=None,
+    ):
+        self.client = client
+        self.spool = spool
+        self.deadband = deadband
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self.written = 0
+        self.failed_flushes = 0
+        self.flush_durations = collections.deque(maxlen=100)
+        self._queue = queue.Queue(maxsize=max_buffer)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._spooled = 0  # points appended to the spool since the last replay
+        self._thread = threading.Thread(
+            target=self._run if spool is None else self._run_spool,
+            name="influxdb-exporter",
+            daemon=True,
+        )
+
+    def start(self):
+        if self.client is None:
+            self.client = make_influxdb_client()
+        self._thread.start()
+
+    def export(self, action, measurements, timestamp=None, tags=None):
+        """
+        Queue measurements for export, without blocking.
+        """
+        if self.deadband is not None:
+            measurements = self.deadband.filter(action, measurements)
+            if not measurements:
+                return
+        point = make_point(action, measurements, timestamp, tags)
+        if self.spool is not None:
+            self.spool.append(point)
+            self._spooled += 1
+            if self._spooled >= self.batch_size:
+                self._wake.set()
+            return
+        while True:
+            try:
+                self._queue.put_nowait(point)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def export_batch(self, results, tags=None):
+        """
+        Queue the results of several actions, a list of (action, measurements), with the same
+        time and tags.
+        """
+        now = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+        for action, measurements in results:
+            self.export(action, measurements, now, tags)
+
+    def stats(self):
+        if self.spool is not None:
+            return {
+                "spooled_bytes": self.spool.pending_bytes(),
+                "evicted_segments": self.spool.evicted,
+                "written": self.written,
+                "failed_flushes": self.failed_flushes,
+                "last_flush_duration": self.flush_durations[-1] if self.flush_durations else None,
+                "max_flush_duration": max(self.flush_durations, default=None),
+            }
+        return {
+            "queue_depth": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_duration": self.flush_durations[-1] if self.flush_durations else None,
+            "max_flush_duration": max(self.flush_durations, default=None),
         }
-    ]
-    try:
-        influx_client.write_points(json_body)
-    except Exception as e:
-        print("Failed to write to influxdb: ", e)
+
+    def close(self, timeout=10):
+        """
+        Write the remaining points and stop the background thread. Gives up after `timeout`
+        seconds.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self.spool is not None:
+            if self._thread.is_alive() or self.spool.pending_bytes() > 0:
+                logger.warning(f"Points left in spool for the next run ({self.stats()})")
+            self.spool.close()
+        elif self._thread.is_alive() or self._queue.qsize() > 0:
+            logger.error(f"Failed to export all points to InfluxDB ({self.stats()})")
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            self.client.write_points(batch)
+        except Exception as e:
+            self.failed_flushes += 1
+            profiler.count("failed_flushes")
+            logger.error(f"Failed to write {len(batch)} points to InfluxDB: {e}")
+            return False
+        duration = time.monotonic() - started
+        profiler.record("export_flush", duration)
+        self.flush_durations.append(duration)
+        self.written += len(batch)
+        logger.debug(
+            f"Wrote {len(batch)} points to InfluxDB in {duration * 1000:.1f} ms, "
+            f"queue depth: {self._queue.qsize()}"
+        )
+        return True
+
+    def _run_spool(self):
+        retry_delay = 0
+        while True:
+            stopping = self._stop.is_set()
+            self._spooled = 0
+            if self.spool.replay(self._flush, self.batch_size):
+                retry_delay = 0
+            else:
+                retry_delay = min(max(retry_delay * 2, 1), 60)
+            if stopping:
+                return
+            self._wake.wait(max(self.max_age, retry_delay))
+            self._wake.clear()
+
+    def _run(self):
+        batch = []
+        deadline = None  # time at which the current batch has to be written
+        retry_delay = 0
+        while True:
+            stopping = self._stop.is_set()
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                if stopping:
+                    return
+                deadline = None
+            elif deadline is None:
+                deadline = time.monotonic() + self.max_age
+
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and (
+                wait <= 0 or (retry_delay == 0 and (stopping or len(batch) >= self.batch_size))
+            ):
+                if self._flush(batch):
+                    batch = []
+                    deadline = None
+                    retry_delay = 0
+                else:
+                    retry_delay = min(max(retry_delay * 2, 1), 60)
+                    deadline = time.monotonic() + retry_delay
+                continue
+
+            # Wait for new points, the deadline of the batch or close()
+            timeout = 0.5 if wait is None else min(wait, 0.5)
+            if len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    pass
+            else:
+                time.sleep(timeout)
@@ -1,10 +1,22 @@
+import collections
 import fcntl
 import io
 import logging
-import pigpio
 import struct
+import threading
 import time
 import sys
+from itho_profile import profiler
+from itho_retry import (
+    NACK,
+    REJECTED,
+    SILENCE,
+    SUCCESS,
+    CircuitBreaker,
+    RetryLoop,
+    RetryPolicies,
+)
+from queue import Empty
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -24,14 +36,81 @@ actions = {
     "getcounters": [0x42, 0x10],
 }
 
+# Seconds to wait for a response before the request is sent again
+default_response_timeout = 0.21
+
+# The BSC peripheral of the Raspberry Pi is the only I2C slave and can't tell which WPU sent a
+# response, so only one I2CBus at a time can receive responses
+slave_lock = threading.Lock()
+
+
+def get_response_identifier(action, response):
+    """
+    Return the setting or manual identifier a response belongs to, used to match responses
+    to requests when several requests are in flight. Returns None when the response isn't a
+    response to `action`, or `action` has no identifier.
+    """
+    if list(response[1:3]) != actions[action]:
+        return None
+    if action in ["getsetting", "setsetting"] and len(response) >= 24:
+        return response[22]
+    if action in ["getmanual", "setmanual"] and len(response) >= 9:
+        return int.from_bytes(response[6:8], byteorder="big")
+    return None
+
+
+def get_response_key(frame):
+    """
+    Return the key of the request a response belongs to: its message class and, for settings
+    and manual operations, its identifier. A request has the same key as its response.
+    """
+    message_class = list(frame[1:3])
+    for action, action_class in actions.items():
+        if action_class == message_class:
+            return bytes(message_class), get_response_identifier(action, frame)
+    return bytes(message_class), None
+
+
+def is_response_to(action, identifier, response):
+    """
+    Return True when a response has the message class of `action` and, for settings and
+    manual operations, the requested identifier.
+    """
+    if list(response[1:3]) != actions[action]:
+        return False
+    if action in ["getsetting", "setsetting", "getmanual", "setmanual"]:
+        return get_response_identifier(action, response) == identifier
+    return True
+
+
+def is_checksum_valid(b):
+    s = 0x80 + sum(b[:-1])
+    checksum = 256 - (s % 256)
+    if checksum == 256:
+        checksum = 0
+    if checksum != b[-1]:
+        logger.debug(f"Checksum invalid (0x{checksum:02x} != 0x{b[-1]:02x})")
+        return False
+    return True
+
+
+def is_length_valid(b):
+    length_in_msg = b[4]
+    actual_length = len(b) - 6
+    if length_in_msg != actual_length:
+        logger.debug(f"Length invalid ({length_in_msg} != {actual_length})")
+        return False
+    return True
+
 
 class I2CRaw:
     def __init__(self, address, bus):
         I2C_SLAVE = 0x0703
-        self.fr = io.open(f"/dev/i2c-{bus}", "rb", buffering=0)
-        self.fw = io.open(f"/dev/i2c-{bus}", "wb", buffering=0)
-        fcntl.ioctl(self.fr, I2C_SLAVE, address)
-        fcntl.ioctl(self.fw, I2C_SLAVE, address)
+        with profiler.stage("i2c_open"):
+            self.fr = io.open(f"/dev/i2c-{bus}", "rb", buffering=0)
+            self.fw = io.open(f"/dev/i2c-{bus}", "wb", buffering=0)
+            fcntl.ioctl(self.fr, I2C_SLAVE, address)
+            fcntl.ioctl(self.fw, I2C_SLAVE, address)
 
     def write_i2c_block_data(self, data):
         if type(data) is not list:
@@ -51,9 +130,28 @@ class I2CRaw:
 
 
 class I2CMaster:
-    def __init__(self, address, bus, queue):
-        self.i = I2CRaw(address=address, bus=bus)
+    def __init__(
+        self,
+        address,
+        bus,
+        queue,
+        timeout=default_response_timeout,
+        timeouts=None,
+        transport=None,
+        policies=None,
+        breaker=None,
+    ):
+        # The transport is closed by its owner when it is passed in
+        self._owns_transport = transport is None
+        self.i = transport if transport is not None else I2CRaw(address=address, bus=bus)
         self.queue = queue
+        self.timeout = timeout
+        self.timeouts = timeouts if timeouts is not None else {}
+        # Pass in the policies and breaker to keep what they learned when the bus is reopened
+        self.policies = policies if policies is not None else RetryPolicies(timeout, timeouts)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.latencies = collections.deque(maxlen=100)
+        self.last_latency = None
 
     def compose_request(self, action, identifier, datatype, value, check):
         if action == "getsetting":
@@ -120,43 +218,157 @@ class I2CMaster:
 
     def execute_action(self, action, identifier, datatype, value, check):
         request = self.compose_request(action, identifier, datatype, value, check)
-        request_in_hex = [hex(c) for c in request]
-        logger.debug(f"Request: {request_in_hex}")
+        logger.debug(f"Request: {bytes(request).hex(' ')}")
         result = None
         if action in ["setsetting", "setmanual"]:
             sure = input("Are you really sure? (Type uppercase yes): ")
             if sure != "YES":
                 logger.error("Aborted")
                 return
-        for i in range(0, 20):
+        # Drop late responses to an earlier request when the slave is kept open
+        while not self.queue.empty():
+            logger.debug(f"Discarding stale response: {self.queue.get_nowait()}")
+        self.last_latency = None
+        loop = RetryLoop(action, self.policies.get(action), self.breaker)
+        for backoff in loop:
+            time.sleep(backoff)
             logger.debug(f"Executing action: {action}")
-            self.i.write_i2c_block_data(request)
-            time.sleep(0.21)
-            logger.debug("Queue size: {}".format(self.queue.qsize()))
-            if self.queue.qsize() > 0:
-                result = self.queue.get()
-                break
-            elif action == "setmanual" and self.queue.qsize() == 0:
-                return None
-
-        if result is None:
-            logger.error("No valid result in 20 requests")
+            rejected = getattr(self.i, "rejected", 0)
+            if not self.write_request(request):
+                loop.record(NACK)
+                continue
+            sent = time.monotonic()
+            try:
+                # Wakes up as soon as the slave callback queues a valid response
+                with profiler.stage("wait_response"):
+                    result = self.wait_response(action, identifier, sent + loop.timeout)
+            except Empty:
+                profiler.count("timeouts")
+                if action == "setmanual":
+                    return None
+                loop.record(SILENCE if getattr(self.i, "rejected", 0) == rejected else REJECTED)
+                continue
+            self.last_latency = time.monotonic() - sent
+            self.latencies.append(self.last_latency)
+            loop.record(SUCCESS, self.last_latency)
+            logger.debug(f"Response received in {self.last_latency * 1000:.1f} ms")
+            break
+        loop.finish(result is not None)
         return result
 
+    def wait_response(self, action, identifier, deadline):
+        """
+        Return the first response to the request of `action` and `identifier` that is received
+        before `deadline` (a time.monotonic() value), raises queue.Empty when there is none.
+        Responses to other requests, e.g. late responses to an earlier request, are discarded.
+        """
+        while True:
+            response = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            if is_response_to(action, identifier, response):
+                return response
+            logger.debug(f"Discarding response to another request: {response.hex(' ')}")
+
+    def write_request(self, request):
+        """
+        Write a request, returns False when the WPU didn't acknowledge it.
+        """
+        try:
+            with profiler.stage("i2c_write"):
+                self.i.write_i2c_block_data(request)
+        except OSError as e:
+            logger.debug(f"Writing request failed: {e}")
+            profiler.count("nacks")
+            return False
+        return True
+
+    def execute_pipelined(self, action, identifiers, depth=4, attempts=None):
+        """
+        Execute a read action for a list of identifiers, keeping up to `depth` requests in
+        flight. Responses are matched to their request by identifier and (identifier, response)
+        tuples are yielded in the order they arrive. The response is None when no valid result
+        was received in `attempts` requests (by default from the retry policy of the action).
+        """
+        if not self.breaker.allow():
+            logger.debug(f"Not executing {action}, the WPU isn't responding")
+            for identifier in identifiers:
+                yield identifier, None
+            return
+        policy = self.policies.get(action)
+        if attempts is None:
+            attempts = policy.get_attempts()
+        timeout = policy.get_timeout()
+        answered = False
+        todo = collections.deque(identifiers)
+        pending = {}  # identifier: [request, time sent, number of attempts]
+        while todo or pending:
+            while todo and len(pending) < depth:
+                identifier = todo.popleft()
+                request = self.compose_request(action, identifier, None, None, True)
+                logger.debug(f"Request: {bytes(request).hex(' ')}")
+                # A request that isn't acknowledged is sent again after the timeout
+                if not self.write_request(request):
+                    policy.record(NACK)
+                pending[identifier] = [request, time.monotonic(), 1]
+
+            deadline = min(p[1] for p in pending.values()) + timeout
+            try:
+                with profiler.stage("wait_response"):
+                    result = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                result = None
+
+            now = time.monotonic()
+            if result is not None:
+                identifier = get_response_identifier(action, result)
+                if identifier in pending:
+                    latency = now - pending.pop(identifier)[1]
+                    self.latencies.append(latency)
+                    policy.record(SUCCESS, latency)
+                    answered = True
+                    yield identifier, result
+                else:
+                    logger.debug(f"Discarding response for unexpected identifier: {identifier}")
+
+            for identifier, p in list(pending.items()):
+                if now - p[1] < timeout:
+                    continue
+                policy.record(SILENCE)
+                if p[2] >= attempts:
+                    logger.error(f"No valid result for {identifier} in {attempts} requests")
+                    del pending[identifier]
+                    yield identifier, None
+                    continue
+                logger.debug(f"Resending request for {identifier}")
+                profiler.count("timeouts")
+                profiler.count("retries")
+                if not self.write_request(p[0]):
+                    policy.record(NACK)
+                p[1] = now
+                p[2] += 1
+        self.breaker.record(answered)
+
     def close(self):
-        self.i.close()
+        if self._owns_transport:
+            self.i.close()
 
 
 class I2CSlave:
     def __init__(self, address, queue):
+        import pigpio
+
         self.address = address
         self.queue = queue
-        self.pi = pigpio.pi()
+        # Number of responses with an invalid checksum or length
+        self.rejected = 0
+        with profiler.stage("pigpio_connect"):
+            self.pi = pigpio.pi()
         if not self.pi.connected:
             logger.error("not pi.connected")
             return
 
     def set_callback(self):
+        import pigpio
+
         logger.debug("set_callback()")
         self.event_callback = self.pi.event_callback(pigpio.EVENT_BSC, self.callback)
         self.pi.bsc_i2c(self.address)
@@ -167,34 +379,78 @@ class I2CSlave:
         result = None
         if b:
             logger.debug(f"Received {b} bytes! Status {s}")
-            result = [hex(c) for c in d]
-            logger.debug(f"Callback Response: {result}")
-            if self.is_checksum_valid(result) and self.is_length_valid(result):
+            result = bytes(d)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Callback Response: {result.hex(' ')}")
+            with profiler.stage("validate"):
+                valid = self.is_checksum_valid(result) and self.is_length_valid(result)
+            if valid:
                 self.queue.put(result)
+            else:
+                self.rejected += 1
+                profiler.count("invalid_responses")
         else:
             logger.debug(f"Received number of bytes was {b}")
 
     def is_checksum_valid(self, b):
-        s = 0x80
-        for i in b[:-1]:
-            s += int(i, 0)
-        checksum = 256 - (s % 256)
-        if checksum == 256:
-            checksum = 0
-        if checksum != int(b[-1], 0):
-            logger.debug(f"Checksum invalid (0x{checksum:02x} != {b[-1]})")
-            return False
-        return True
+        return is_checksum_valid(b)
 
     def is_length_valid(self, b):
-        length_in_msg = int(b[4], 0)
-        actual_length = len(b) - 6
-        if length_in_msg != actual_length:
-            logger.debug(f"Length invalid ({length_in_msg} != {actual_length})")
-            return False
-        return True
+        return is_length_valid(b)
 
     def close(self):
         self.event_callback.cancel()
         self.pi.bsc_i2c(0)
         self.pi.stop()
+
+
+class I2CBus:
+    """
+    Transport over the I2C bus of the Raspberry Pi. Requests are written as I2C master with
+    `/dev/i2c-N` and responses of the WPU are received as I2C slave with pigpio and put on
+    the queue passed to `open`.
+
+    Other transports (see itho_transport) implement the same methods: `open(queue)`,
+    `write_i2c_block_data(data)` and `close()`, and optionally `rejected`: the number of
+    responses that were dropped because of an invalid checksum or length.
+    """
+
+    def __init__(self, bus=1, master_address=0x41, slave_address=0x40, master=True, slave=True):
+        self.bus = bus
+        self.master_address = master_address
+        self.slave_address = slave_address
+        self.master = master
+        self.slave = slave
+        self._raw = None
+        self._slave = None
+
+    def open(self, queue):
+        if self.slave and self._slave is None:
+            slave_lock.acquire()
+            try:
+                self._slave = I2CSlave(address=self.slave_address, queue=queue)
+                self._slave.set_callback()
+            except BaseException:
+                self._slave = None
+                slave_lock.release()
+                raise
+        if self.master and self._raw is None:
+            self._raw = I2CRaw(address=self.master_address, bus=self.bus)
+
+    @property
+    def rejected(self):
+        return self._slave.rejected if self._slave is not None else 0
+
+    def write_i2c_block_data(self, data):
+        return self._raw.write_i2c_block_data(data)
+
+    def close(self):
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+        if self._slave is not None:
+            try:
+                self._slave.close()
+            finally:
+                self._slave = None
+                slave_lock.release()
@@ -0,0 +1,105 @@
+import logging
+import os
+import sys
+import threading
+from itho_profile import profiler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+
+class MetadataIndex:
+    """
+    Datalabels, settings, manual operations and counters of one list version. Settings and
+    manual operations are indexed by their id, datalabels and counters are ordered by id.
+    """
+
+    def __init__(self, listversion, datalabels, settings, manuals, counters):
+        self.listversion = listversion
+        self.datalabels = datalabels
+        self.settings = settings
+        self.manuals = manuals
+        self.counters = counters
+
+
+class HeatpumpMetadata:
+    """
+    In-memory index of the Itho database (heatpump.sqlite). The rows of a list version are
+    loaded once and the index is rebuilt when the database file changes. It can be shared by
+    threads.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._db = None
+        self._signature = None
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _get_signature(self):
+        stat = os.stat(self.db_file)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, listversion):
+        with profiler.stage("metadata_lookup"), self._lock:
+            return self._get(listversion)
+
+    def _get(self, listversion):
+        signature = self._get_signature()
+        if signature != self._signature:
+            if self._signature is not None:
+                logger.debug(f"{self.db_file} changed, reloading metadata")
+            self._signature = signature
+            self._indexes = {}
+        if listversion not in self._indexes:
+            self._indexes[listversion] = self._load(listversion)
+        return self._indexes[listversion]
+
+    def _select(self, table, version, columns):
+        if version is None or type(version) is not int:
+            return None
+        return self._db.execute(f"SELECT {columns} FROM {table}_v{version} ORDER BY id")
+
+    def _load(self, listversion):
+        with profiler.stage("sqlite_open"):
+            import db
+
+            self._db = db.sqlite(self.db_file)
+        try:
+            return self._load_version(listversion)
+        finally:
+            # A connection can only be used by the thread that opened it
+            self._db.conn.close()
+            self._db = None
+
+    def _load_version(self, listversion):
+        versions = self._db.execute("SELECT * FROM versiebeheer WHERE version = ?", (listversion,))
+        if not versions:
+            logger.error(f"Version {listversion} not found in database")
+            return None
+        version = versions[0]
+        logger.debug(f"Loading metadata for version {listversion} from {self.db_file}")
+
+        datalabels = self._select(
+            "datalabel", version["datalabel"], "id, name, title, tooltip, unit"
+        )
+        settings = self._select(
+            "parameterlijst",
+            version["parameterlist"],
+            "id, name, min, max, def, title, description, unit",
+        )
+        manuals = self._select(
+            "handbed", version["handbed"], "id, name, min, max, def, title, tooltip, unit"
+        )
+        counters = self._select("counters", version["counters"], "id, name, title, tooltip, unit")
+
+        return MetadataIndex(
+            listversion,
+            datalabels,
+            {int(s["id"]): s for s in settings} if settings is not None else None,
+            {int(m["id"]): m for m in manuals} if manuals is not None else None,
+            counters,
+        )
@@ -0,0 +1,155 @@
+import collections
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+# action: (metric name, help text)
+metric_names = {
+    "getdatalog": ("itho_wpu_datalog", "Datalog value of the WPU, by datalabel"),
+    "getcounters": ("itho_wpu_counter", "Counter of the WPU, by counter name"),
+}
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsSnapshot:
+    """
+    The latest poll results in Prometheus text format. The text of each action is rendered
+    when it is updated, so a scrape only joins prepared strings and never touches the bus.
+    """
+
+    actions = list(metric_names)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sections = {}  # action: rendered metrics
+        self._polled = {}  # action: unix timestamp of the last successful poll
+        self._errors = {}  # (action, kind): number of errors
+        self._latencies = collections.deque(maxlen=100)
+        self._latency_quantiles = {}
+        self._latency_sum = 0
+        self._latency_count = 0
+
+    def update(self, action, values):
+        name, help_text = metric_names[action]
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for label, value in values.items():
+            if value is None:
+                continue
+            lines.append(f'{name}{{label="{escape_label_value(label)}"}} {value}')
+        with self._lock:
+            self._sections[action] = "\n".join(lines) + "\n"
+            self._polled[action] = time.time()
+
+    def record_error(self, action, kind):
+        """
+        Count a failed poll. `kind` is "bus" when no valid response was received and "decode"
+        when the response could not be decoded.
+        """
+        with self._lock:
+            self._errors[(action, kind)] = self._errors.get((action, kind), 0) + 1
+
+    def record_latencies(self, latencies):
+        """
+        Add new bus round-trip times (in seconds). Quantiles are calculated over the last 100.
+        """
+        latencies = list(latencies)
+        if not latencies:
+            return
+        with self._lock:
+            self._latencies.extend(latencies)
+            self._latency_sum += sum(latencies)
+            self._latency_count += len(latencies)
+            ordered = sorted(self._latencies)
+            for q in [0.5, 0.9, 0.99]:
+                self._latency_quantiles[q] = ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def render(self):
+        now = time.time()
+        with self._lock:
+            lines = list(self._sections.values())
+            lines.append(
+                "# HELP itho_wpu_last_poll_timestamp_seconds Time of the last successful poll\n"
+                "# TYPE itho_wpu_last_poll_timestamp_seconds gauge\n"
+            )
+            for action, polled in self._polled.items():
+                lines.append(
+                    f'itho_wpu_last_poll_timestamp_seconds{{action="{action}"}} {polled}\n'
+                )
+            lines.append(
+                "# HELP itho_wpu_poll_age_seconds Seconds since the last successful poll\n"
+                "# TYPE itho_wpu_poll_age_seconds gauge\n"
+            )
+            for action, polled in self._polled.items():
+                lines.append(
+                    f'itho_wpu_poll_age_seconds{{action="{action}"}} {round(now - polled, 3)}\n'
+                )
+            lines.append(
+                "# HELP itho_wpu_poll_errors_total Failed polls, by action and kind of error\n"
+                "# TYPE itho_wpu_poll_errors_total counter\n"
+            )
+            for (action, kind), count in self._errors.items():
+                lines.append(
+                    f'itho_wpu_poll_errors_total{{action="{action}",kind="{kind}"}} {count}\n'
+                )
+            lines.append(
+                "# HELP itho_wpu_bus_latency_seconds Round-trip time of I2C requests\n"
+                "# TYPE itho_wpu_bus_latency_seconds summary\n"
+            )
+            for q, latency in self._latency_quantiles.items():
+                lines.append(f'itho_wpu_bus_latency_seconds{{quantile="{q}"}} {latency}\n')
+            lines.append(f"itho_wpu_bus_latency_seconds_sum {self._latency_sum}\n")
+            lines.append(f"itho_wpu_bus_latency_seconds_count {self._latency_count}\n")
+        return "".join(lines).encode()
+
+
+class MetricsServer:
+    """
+    HTTP server that serves a MetricsSnapshot on /metrics from a background thread.
+    """
+
+    def __init__(self, snapshot, host="", port=9118):
+        self.snapshot = snapshot
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = snapshot.render()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logger.debug(f"{handler.address_string()} - {format % args}")
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics-server", daemon=True
+        )
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        logger.debug(f"Serving metrics on port {self.port}")
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,152 @@
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the histogram buckets, the last bucket has no upper bound
+bucket_bounds = [
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+]
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.buckets[bisect.bisect_left(bucket_bounds, seconds)] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "buckets": {
+                str(bound): n for bound, n in zip(bucket_bounds + ["+Inf"], self.buckets) if n > 0
+            },
+        }
+
+
+class Profiler:
+    """
+    Timing histograms per stage of a run (cache load, I2C write, waiting for the slave,
+    decoding, export, ...) and counters of events like retries.
+
+    A disabled profiler doesn't measure anything, so the instrumentation can stay in place:
+
+        with profiler.stage("decode"):
+            ...
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}  # stage: Histogram
+        self.counters = {}  # name: number of events
+        self._lock = threading.Lock()
+        self._disabled = contextlib.nullcontext()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].add(seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stage(self, stage):
+        if not self.enabled:
+            return self._disabled
+        return self._measure(stage)
+
+    @contextlib.contextmanager
+    def _measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "stages": {stage: h.to_dict() for stage, h in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def report(self):
+        """
+        Return the stages and counters as a table, slowest stages first.
+        """
+        lines = [
+            f"{'stage':24} {'count':>7} {'total ms':>10} {'avg ms':>9} {'min ms':>9} {'max ms':>9}"
+        ]
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda s: s[1].total, reverse=True)
+            for stage, h in stages:
+                lines.append(
+                    f"{stage:24} {h.count:7} {h.total * 1000:10.2f} "
+                    f"{h.total / h.count * 1000:9.3f} {h.min * 1000:9.3f} {h.max * 1000:9.3f}"
+                )
+            for name, n in sorted(self.counters.items()):
+                lines.append(f"{name:24} {n:7}")
+        return "\n".join(lines)
+
+
+def get_process_age():
+    """
+    Return the seconds since the process was started, or None when unknown (not Linux).
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The process name can contain spaces, the fields after it can't
+            starttime = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - starttime / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+profiler = Profiler()
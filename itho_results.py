@@ -0,0 +1,200 @@
+import collections
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+# Results of the actions. `name`, `title` and `unit` are taken from the database, `value`,
+# `minimum`, `maximum` and `step` are numbers.
+NodeId = collections.namedtuple(
+    "NodeId",
+    ["manufacturergroup", "manufacturer", "hardwaretype", "productversion", "listversion"],
+)
+Serial = collections.namedtuple("Serial", ["serial"])
+Setting = collections.namedtuple(
+    "Setting", ["id", "name", "title", "unit", "value", "minimum", "maximum", "step"]
+)
+Manual = collections.namedtuple("Manual", ["id", "name", "title", "unit", "value"])
+Counter = collections.namedtuple("Counter", ["id", "name", "title", "unit", "value"])
+
+hardware_info = {
+    0: {
+        "name": "HCCP",
+        "type": {
+            13: "WPU",
+            15: "Autotemp",
+        },
+    }
+}
+
+
+def format_datatype(name, m, dt):
+    """
+    Transform bytes to a readable number based on the datatype.
+
+    :param str name: Name/label of the data
+    :param bytes m: Bytes of the value
+    :param int dt: Datatype
+    """
+
+    num = None
+    if dt == 0x0 or dt == 0xC:
+        num = m[-1]
+    elif dt == 0x1:
+        num = round(m[-1] / 10, 1)
+    elif dt == 0x2:
+        num = round(m[-1] / 100, 2)
+    elif dt == 0x10:
+        num = (m[-2] << 8) + m[-1]
+    elif dt == 0x12:
+        num = round((m[-2] << 8) + m[-1] / 100, 2)
+    elif dt == 0x13:
+        num = round((m[-2] << 8) + m[-1] / 1000, 3)
+    elif dt == 0x14:
+        num = round((m[-2] << 8) + m[-1] / 10000, 4)
+    elif dt == 0x80:
+        num = m[-1]
+        if num >= 128:
+            num -= 256
+    elif dt == 0x81:
+        num = m[-1]
+        if num >= 128:
+            num -= 256
+        num = round(num / 10, 1)
+    elif dt == 0x82:
+        num = m[-1]
+        if num >= 128:
+            num -= 256
+        num = round(num / 100, 2)
+    elif dt == 0x8F:
+        num = m[-1]
+        if num >= 128:
+            num -= 256
+        num = round(num / 1000, 3)
+    elif dt == 0x90:
+        num = (m[-2] << 8) + m[-1]
+        if num >= 32768:
+            num -= 65536
+    elif dt == 0x91:
+        num = (m[-2] << 8) + m[-1]
+        if num >= 32768:
+            num -= 65536
+        num = round(num / 10, 2)
+    elif dt == 0x92:
+        num = (m[-2] << 8) + m[-1]
+        if num >= 32768:
+            num -= 65536
+        num = round(num / 100, 2)
+    elif dt == 0x20:
+        num = (m[-4] << 24) + (m[-3] << 16) + (m[-2] << 8) + m[-1]
+    else:
+        logger.error(f"Unknown datatype for '{name}': 0x{dt:X}")
+    return num
+
+
+def parse_nodeid(response):
+    hardware = hardware_info[response[7]]
+    return NodeId(
+        manufacturergroup=(response[5] << 8) + response[6],
+        manufacturer=hardware["name"],
+        hardwaretype=hardware["type"][response[8]],
+        productversion=response[9],
+        listversion=response[10],
+    )
+
+
+def parse_serial(response):
+    return Serial((response[5] << 16) + (response[6] << 8) + response[7])
+
+
+def parse_setting(response, setting):
+    """
+    :param setting: Setting in the database (see itho_metadata)
+    """
+    message = response[5:]
+    datatype = message[16]
+    name = setting["name"]
+    return Setting(
+        id=message[17],
+        name=name,
+        title=setting["title"],
+        unit=setting["unit"],
+        value=format_datatype(name, message[0:4], datatype),
+        minimum=format_datatype(name, message[4:8], datatype),
+        maximum=format_datatype(name, message[8:12], datatype),
+        step=format_datatype(name, message[12:16], datatype),
+    )
+
+
+def parse_manual(response, manual):
+    """
+    :param manual: Manual operation in the database (see itho_metadata)
+    """
+    message = response[5:]
+    return Manual(
+        id=int.from_bytes(message[1:3], byteorder="big"),
+        name=manual["name"],
+        title=manual["title"],
+        unit=manual["unit"],
+        value=format_datatype(manual["name"], message[4:6], message[3]),
+    )
+
+
+def parse_counters(response, counters):
+    """
+    :param counters: Counters in the database (see itho_metadata)
+    """
+    message = response[5:]
+    results = []
+    for c in counters:
+        index = int(c["id"]) * 2
+        value = format_datatype(c["name"], message[index : index + 2], 0x10)  # noqa: E203
+        results.append(Counter(int(c["id"]), c["name"], c["title"], c["unit"], value))
+    return results
+
+
+def format_nodeid(nodeid):
+    return (
+        f"ManufacturerGroup: {nodeid.manufacturergroup}, Manufacturer: {nodeid.manufacturer}, "
+        f"HardwareType: {nodeid.hardwaretype}, ProductVersion: {nodeid.productversion}, "
+        f"ListVersion: {nodeid.listversion}"
+    )
+
+
+def format_serial(serial):
+    return f"Serial: {serial.serial}"
+
+
+def format_setting(setting):
+    return "{}. {}{}: {} (min: {}, max: {}, step: {})".format(
+        setting.id,
+        setting.title.title(),
+        f" ({setting.unit})" if setting.unit is not None else "",
+        setting.value,
+        setting.minimum,
+        setting.maximum,
+        setting.step,
+    )
+
+
+def format_manual(manual):
+    return "{}. {}{}: {}".format(
+        manual.id,
+        manual.title.title(),
+        f" ({manual.unit})" if manual.unit is not None else "",
+        manual.value,
+    )
+
+
+def format_counter(counter):
+    return "{}. {} ({}): {}{}".format(
+        counter.id,
+        counter.title.title(),
+        counter.name.lower(),
+        counter.value,
+        " " + counter.unit if counter.unit is not None else "",
+    )
@@ -0,0 +1,271 @@
+import collections
+import logging
+import math
+import sys
+import time
+from itho_profile import profiler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+# Outcomes of a request
+SUCCESS = "success"
+NACK = "nack"  # writing the request failed, the WPU is busy or nothing is connected
+REJECTED = "rejected"  # a response was received, but with an invalid checksum or length
+SILENCE = "silence"  # no response within the timeout
+
+failure_descriptions = {NACK: "not acknowledged", REJECTED: "invalid", SILENCE: "no response"}
+
+
+class RetryPolicy:
+    """
+    How often and how fast a request of an action is sent again.
+
+    The number of attempts and the response timeout are tuned from the observed results: when
+    most requests are answered the first time, fewer attempts are needed to reach
+    `target_success`, and the timeout is lowered to a margin above the observed response times
+    (never above `timeout`). Between attempts it waits an exponentially increasing backoff with
+    jitter, except after an invalid response, which is caused by noise on the bus rather than by
+    a busy WPU. A request is given up after `max_duration` seconds (None for no limit).
+    """
+
+    def __init__(
+        self,
+        timeout,
+        max_attempts=20,
+        min_attempts=3,
+        target_success=0.999,
+        min_timeout=0.05,
+        backoff=0.02,
+        max_backoff=0.5,
+        jitter=0.5,
+        max_duration=2.5,
+        adaptive=True,
+    ):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.min_attempts = min_attempts
+        self.target_success = target_success
+        self.min_timeout = min_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_duration = max_duration
+        self.adaptive = adaptive
+        # Exponentially weighted averages of the attempts and of the response times
+        self.weight = 0.05
+        self.samples = 0
+        self.success_rate = None
+        self.latency = None
+        self.latency_deviation = 0
+
+    def record(self, outcome, latency=None):
+        """
+        Record the outcome of an attempt, with its response time when it succeeded.
+        """
+        self.samples += 1
+        success = 1 if outcome == SUCCESS else 0
+        if self.success_rate is None:
+            self.success_rate = success
+        else:
+            self.success_rate += self.weight * (success - self.success_rate)
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency_deviation += self.weight * (
+                    abs(latency - self.latency) - self.latency_deviation
+                )
+                self.latency += self.weight * (latency - self.latency)
+
+    def get_attempts(self):
+        if not self.adaptive or self.samples < 10:
+            return self.max_attempts
+        # Attempts needed to reach target_success when attempts are independent
+        p = min(max(self.success_rate, 0.01), 0.99)
+        attempts = math.ceil(math.log(1 - self.target_success) / math.log(1 - p))
+        return min(max(attempts, self.min_attempts), self.max_attempts)
+
+    def get_timeout(self):
+        if not self.adaptive or self.samples < 10 or self.latency is None:
+            return self.timeout
+        timeout = self.latency + 4 * self.latency_deviation + self.min_timeout
+        return min(max(timeout, self.min_timeout), self.timeout)
+
+    def get_backoff(self, attempt, outcome):
+        """
+        Seconds to wait before attempt `attempt` (1 is the first retry) after `outcome`.
+        """
+        if outcome == REJECTED:
+            return 0
+        # Imported on first use, it isn't needed when requests succeed the first time
+        import random
+
+        backoff = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return backoff * random.uniform(1 - self.jitter, 1)
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "success_rate": self.success_rate,
+            "latency": self.latency,
+            "attempts": self.get_attempts(),
+            "timeout": self.get_timeout(),
+        }
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests when the WPU doesn't respond.
+
+    After `threshold` failed requests in a row the circuit opens and requests fail at once for
+    `reset_timeout` seconds. Then a single request is let through as probe: when it succeeds
+    the circuit closes, otherwise it opens again for twice as long, up to `max_reset_timeout`.
+    """
+
+    def __init__(self, threshold=3, reset_timeout=10, max_reset_timeout=300):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.failures = 0
+        self.opened = None  # time the circuit was opened, None when closed
+        self.open_for = reset_timeout
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        """
+        Return True when a request may be sent.
+        """
+        if self.opened is None:
+            return True
+        if self.probing or time.monotonic() - self.opened < self.open_for:
+            profiler.count("circuit_open")
+            return False
+        logger.debug("Probing the WPU")
+        self.probing = True
+        return True
+
+    def record(self, success):
+        """
+        Record the result of a request.
+        """
+        if success:
+            if self.opened is not None:
+                logger.info("WPU is responding again")
+            self.failures = 0
+            self.opened = None
+            self.open_for = self.reset_timeout
+            self.probing = False
+            return
+        self.failures += 1
+        if self.probing:
+            self.open_for = min(self.open_for * 2, self.max_reset_timeout)
+        elif self.failures < self.threshold or self.opened is not None:
+            return
+        self.probing = False
+        self.opened = time.monotonic()
+        logger.warning(
+            f"WPU didn't respond to {self.failures} requests, "
+            f"pausing requests for {self.open_for} seconds"
+        )
+
+
+class RetryPolicies:
+    """
+    Retry policy per action, created on first use. Set actions don't adapt their timeout and
+    attempts, to not send a change twice because a response was slow.
+    """
+
+    def __init__(self, timeout, timeouts=None, **kwargs):
+        self.timeout = timeout
+        self.timeouts = timeouts if timeouts is not None else {}
+        self.kwargs = kwargs
+        self.policies = {}  # action: RetryPolicy
+
+    def get(self, action):
+        if action not in self.policies:
+            kwargs = dict(self.kwargs)
+            if action.startswith("set"):
+                kwargs["adaptive"] = False
+                kwargs["max_duration"] = None
+            timeout = self.timeouts.get(action, self.timeout)
+            self.policies[action] = RetryPolicy(timeout, **kwargs)
+        return self.policies[action]
+
+
+class RetryLoop:
+    """
+    The attempts of one request under the retry policy of its action and the circuit breaker,
+    shared by I2CMaster and itho_async, which write the requests and wait for the responses.
+    Iterating yields the seconds to wait before every attempt:
+
+        loop = RetryLoop(action, policies.get(action), breaker)
+        for backoff in loop:
+            time.sleep(backoff)
+            # write the request, then loop.record(NACK) and continue when that failed, wait
+            # for the response, then loop.record(SILENCE) and continue when there is none
+            loop.record(SUCCESS, latency)
+            break
+        loop.finish(response is not None)
+
+    Nothing is yielded while the circuit is open.
+    """
+
+    def __init__(self, action, policy, breaker):
+        self.action = action
+        self.policy = policy
+        self.breaker = breaker
+        self.timeout = policy.get_timeout()
+        self.failures = collections.Counter()
+        self.allowed = None
+        self._outcome = None
+
+    def __iter__(self):
+        self.allowed = self.breaker.allow()
+        if not self.allowed:
+            logger.debug(f"Not executing {self.action}, the WPU isn't responding")
+            return
+        policy = self.policy
+        attempts = policy.min_attempts if self.breaker.probing else policy.get_attempts()
+        started = time.monotonic()
+        for i in range(0, attempts):
+            if i == 0:
+                yield 0
+                continue
+            if policy.max_duration is not None:
+                if time.monotonic() - started >= policy.max_duration:
+                    return
+            profiler.count("retries")
+            yield policy.get_backoff(i, self._outcome)
+
+    def record(self, outcome, latency=None):
+        """
+        Record the outcome of an attempt, with its response time when it succeeded.
+        """
+        self.policy.record(outcome, latency)
+        if outcome == SUCCESS:
+            return
+        self._outcome = outcome
+        self.failures[outcome] += 1
+        if outcome != NACK:
+            logger.debug(f"No valid response within {self.timeout} seconds ({outcome})")
+
+    def finish(self, success):
+        """
+        Record the result of the request in the circuit breaker, after the last attempt.
+        """
+        if not self.allowed:
+            return
+        if not success:
+            details = ", ".join(
+                f"{failure_descriptions[o]}: {n}" for o, n in self.failures.items()
+            )
+            logger.error(f"No valid result in {sum(self.failures.values())} requests ({details})")
+        self.breaker.record(success)
@@ -0,0 +1,215 @@
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+import types
+from itho_profile import Histogram, profiler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+# Priority of jobs and tasks, lower runs first
+default_priority = 10
+interactive_priority = 0
+
+
+class Job:
+    """
+    A job that is run every `interval` seconds. A run that starts more than `deadline` seconds
+    after it was due is skipped, None runs it however late it is.
+
+    When `fn` returns a generator, the run is executed one step (`next`) at a time and jobs
+    with a higher priority can run between the steps.
+    """
+
+    def __init__(self, name, fn, interval, priority=default_priority, deadline=None):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.priority = priority
+        self.deadline = deadline
+        self.runs = 0
+        self.skipped = 0
+        self.lag = Histogram()  # seconds between the time a run was due and its start
+        self.duration = Histogram()
+        self._generator = None
+        self._started = None
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "lag_avg": self.lag.total / self.lag.count if self.lag.count else None,
+            "lag_max": self.lag.max,
+            "duration_max": self.duration.max,
+        }
+
+
+class Task:
+    """
+    A function that is run once, its result or exception is set on `future`.
+    """
+
+    def __init__(self, fn, priority):
+        self.fn = fn
+        self.priority = priority
+        self.future = concurrent.futures.Future()
+
+
+class Scheduler:
+    """
+    Runs jobs and tasks one at a time in the thread that calls `run`, so all bus work is
+    serialized. Of the jobs and tasks that are due, the one with the lowest priority runs
+    first, then the one that has been due longest.
+
+        scheduler = Scheduler()
+        scheduler.add("getdatalog", lambda: wpu.call("getdatalog"), 5, priority=1, deadline=2)
+        scheduler.add("getcounters", lambda: wpu.call("getcounters"), 3600)
+        threading.Thread(target=scheduler.run, daemon=True).start()
+        response = scheduler.submit(lambda: wpu.call("getsetting", 1)).result()
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self._waiting = []  # heap of (due, seq, job or task)
+        self._ready = []  # heap of (priority, due, seq, job or task)
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def add(self, name, fn, interval, priority=default_priority, deadline=None):
+        """
+        Add a job, which is first run as soon as possible.
+        """
+        job = Job(name, fn, interval, priority, deadline)
+        self.jobs.append(job)
+        self._push(job, time.monotonic())
+        return job
+
+    def submit(self, fn, priority=interactive_priority):
+        """
+        Run `fn` once, before the jobs and tasks with a higher priority that are due. Can be
+        called from any thread. Returns a concurrent.futures.Future of the result.
+        """
+        task = Task(fn, priority)
+        self._push(task, time.monotonic())
+        return task.future
+
+    def _push(self, item, due):
+        with self._condition:
+            heapq.heappush(self._waiting, (due, next(self._seq), item))
+            self._condition.notify()
+
+    def _pop(self, timeout=None):
+        """
+        Return the next (due, job or task) to run, or None when nothing is due within
+        `timeout` seconds or the scheduler is stopped.
+        """
+        until = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                while self._waiting and self._waiting[0][0] <= now:
+                    due, seq, item = heapq.heappop(self._waiting)
+                    heapq.heappush(self._ready, (item.priority, due, seq, item))
+                if self._ready:
+                    _, due, _, item = heapq.heappop(self._ready)
+                    return due, item
+                wait = None if not self._waiting else self._waiting[0][0] - now
+                if until is not None:
+                    if now >= until:
+                        return None
+                    wait = until - now if wait is None else min(wait, until - now)
+                self._condition.wait(wait)
+        return None
+
+    def run_next(self, timeout=None):
+        """
+        Run the next job, step of a job or task, waiting up to `timeout` seconds (None waits
+        until something is due). Returns False when nothing ran.
+        """
+        entry = self._pop(timeout)
+        if entry is None:
+            return False
+        due, item = entry
+        if isinstance(item, Task):
+            self._run_task(item)
+        else:
+            self._run_job(item, due)
+        return True
+
+    def run(self):
+        """
+        Run jobs and tasks until `stop` is called.
+        """
+        while not self._stopped:
+            self.run_next()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _run_task(self, task):
+        if not task.future.set_running_or_notify_cancel():
+            return
+        try:
+            task.future.set_result(task.fn())
+        except Exception as e:
+            task.future.set_exception(e)
+
+    def _run_job(self, job, due):
+        now = time.monotonic()
+        if job._generator is None:
+            lag = now - due
+            if job.deadline is not None and lag > job.deadline:
+                logger.debug(f"Skipping {job.name}, it is {lag:.2f} seconds late")
+                job.skipped += 1
+                profiler.count("scheduler_skipped")
+                self._reschedule(job, due, now)
+                return
+            job.runs += 1
+            job.lag.add(lag)
+            profiler.record(f"lag_{job.name}", lag)
+            job._started = now
+            result = job.fn()
+            if not isinstance(result, types.GeneratorType):
+                self._finish(job, due)
+                return
+            job._generator = result
+        try:
+            next(job._generator)
+        except StopIteration:
+            job._generator = None
+            self._finish(job, due)
+            return
+        except BaseException:
+            job._generator = None
+            raise
+        # Continue with the next step after the jobs and tasks of a higher priority
+        with self._condition:
+            heapq.heappush(self._ready, (job.priority, due, next(self._seq), job))
+
+    def _finish(self, job, due):
+        now = time.monotonic()
+        job.duration.add(now - job._started)
+        self._reschedule(job, due, now)
+
+    def _reschedule(self, job, due, now):
+        # Runs that were missed because the previous run was late or slow are skipped, the
+        # job keeps its cadence
+        missed = max(0, int((now - due) // job.interval))
+        if missed > 0:
+            logger.debug(f"Skipping {missed} runs of {job.name}")
+            job.skipped += missed
+            profiler.count("scheduler_skipped", missed)
+        self._push(job, due + (missed + 1) * job.interval)
+
+    def stats(self):
+        return {job.name: job.stats() for job in self.jobs}
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+setting_fields = ["value", "min", "max", "step"]
+
+
+class SettingsSnapshot:
+    """
+    Values, minimum, maximum and step of all settings of a WPU, tagged with its serial and
+    nodeid and the time every setting was read. Stored as JSON in `path`.
+
+    A snapshot of another WPU (a replaced controller or a firmware update) is discarded.
+    """
+
+    def __init__(self, path, serial, nodeid):
+        self.path = path
+        self.serial = serial
+        self.nodeid = nodeid
+        self.time = None
+        self.settings = {}  # settingid: {"value", "min", "max", "step", "time"}
+        self.changes = []  # (settingid, field, previous value, value)
+        self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.debug(f"Not loading settings snapshot: {self.path} does not exist")
+            return
+        except ValueError as e:
+            logger.warning(f"Ignoring invalid settings snapshot {self.path}: {e}")
+            return
+        if data["serial"] != self.serial or data["nodeid"] != self.nodeid:
+            logger.warning(
+                f"Ignoring settings snapshot {self.path} of another WPU "
+                f"(serial: {data['serial']}, nodeid: {data['nodeid']})"
+            )
+            return
+        self.time = data["time"]
+        self.settings = {int(settingid): s for settingid, s in data["settings"].items()}
+
+    def get_oldest(self, settingids, n):
+        """
+        Return the `n` settings of `settingids` that were read longest ago, settings that are
+        missing in the snapshot first.
+        """
+        return sorted(
+            settingids, key=lambda settingid: self.settings.get(settingid, {}).get("time", 0)
+        )[:n]
+
+    def update(self, settingid, value, minimum, maximum, step):
+        """
+        Store a setting that was read. Changes since the previous read are added to `changes`.
+        """
+        setting = {"value": value, "min": minimum, "max": maximum, "step": step}
+        previous = self.settings.get(settingid)
+        if previous is not None:
+            for field in setting_fields:
+                if previous[field] != setting[field]:
+                    self.changes.append((settingid, field, previous[field], setting[field]))
+        setting["time"] = time.time()
+        self.settings[settingid] = setting
+
+    def save(self):
+        self.time = time.time()
+        data = {
+            "serial": self.serial,
+            "nodeid": self.nodeid,
+            "time": self.time,
+            "settings": self.settings,
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.changes = []
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+
+class Spool:
+    """
+    Append-only on-disk spool of points waiting to be exported.
+
+    Points are appended as compact JSON lines to segment files in `directory`. To limit SD card
+    wear the segment is fsync'ed at most once every `fsync_interval` seconds, and when it is
+    closed. A new segment is started when the current one reaches `segment_bytes`. When the
+    spool grows beyond `max_bytes` the oldest segments are removed.
+
+    `replay` sends the spooled points in batches and removes segments once all their points
+    were sent. The replay position is only kept in memory, so after a restart points of a
+    partly replayed segment are sent again. InfluxDB overwrites points with the same
+    measurement and time, so this doesn't result in duplicates.
+    """
+
+    def __init__(self, directory, max_bytes=50_000_000, segment_bytes=1_000_000, fsync_interval=5):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._offsets = {}  # segment: number of bytes replayed
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".jsonl")
+        )
+        self._file = None
+        self._open_segment()
+
+    def _open_segment(self):
+        if self._segments:
+            sequence = int(os.path.basename(self._segments[-1]).split(".")[0]) + 1
+        else:
+            sequence = 0
+        path = os.path.join(self.directory, f"{sequence:012d}.jsonl")
+        self._segments.append(path)
+        self._file = open(path, "ab")
+        self._size = 0
+        self._synced = time.monotonic()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        self._open_segment()
+        self._evict()
+
+    def _evict(self):
+        sizes = [os.path.getsize(s) for s in self._segments]
+        total = sum(sizes)
+        # Never remove the segment that is currently written to
+        while total > self.max_bytes and len(self._segments) > 1:
+            segment = self._segments.pop(0)
+            total -= sizes.pop(0)
+            self._offsets.pop(segment, None)
+            os.remove(segment)
+            self.evicted += 1
+            logger.warning(f"Spool is full, removed oldest segment {segment}")
+
+    def append(self, point):
+        line = json.dumps(point, separators=(",", ":")).encode() + b"\n"
+        with self._lock:
+            self._file.write(line)
+            self._size += len(line)
+            if self._size >= self.segment_bytes:
+                self._rotate()
+            elif time.monotonic() - self._synced >= self.fsync_interval:
+                self._sync()
+
+    def pending_bytes(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+            return sum(os.path.getsize(s) - self._offsets.get(s, 0) for s in self._segments)
+
+    def replay(self, write, batch_size=1000):
+        """
+        Send all spooled points, oldest first, in batches of at most `batch_size` points with
+        `write(points)`. Returns False when a batch could not be written.
+        """
+        with self._lock:
+            self._file.flush()
+            segments = list(self._segments)
+            current = segments[-1]
+            current_size = self._size
+
+        for segment in segments:
+            offset = self._offsets.get(segment, 0)
+            try:
+                with open(segment, "rb") as f:
+                    f.seek(offset)
+                    data = f.read(current_size - offset) if segment == current else f.read()
+            except FileNotFoundError:
+                # Removed because the spool was full
+                continue
+
+            points = []
+            ends = []  # offset in data after each point
+            start = 0
+            # A partly written last line is ignored, it is read again on the next replay
+            end = data.find(b"\n", start)
+            while end != -1:
+                try:
+                    points.append(json.loads(data[start:end]))
+                    ends.append(end + 1)
+                except ValueError:
+                    logger.warning(f"Skipping invalid line in spool segment {segment}")
+                start = end + 1
+                end = data.find(b"\n", start)
+
+            sent = 0
+            while sent < len(points):
+                batch = points[sent : sent + batch_size]  # noqa: E203
+                if not write(batch):
+                    # Resume after the last batch that was written
+                    if sent > 0:
+                        self._offsets[segment] = offset + ends[sent - 1]
+                    return False
+                sent += len(batch)
+
+            with self._lock:
+                if segment != current and segment in self._segments:
+                    self._segments.remove(segment)
+                    self._offsets.pop(segment, None)
+                    os.remove(segment)
+                elif segment in self._segments:
+                    self._offsets[segment] = offset + start
+        return True
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+            # Remove the current segment when all its points were replayed
+            if self._offsets.get(self._segments[-1], 0) == self._size:
+                os.remove(self._segments.pop())
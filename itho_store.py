@@ -0,0 +1,235 @@
+import array
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+# struct format character: (array typecode, NumPy dtype)
+column_types = {
+    "B": ("B", "<u1"),
+    "b": ("b", "<i1"),
+    "H": ("H", "<u2"),
+    "h": ("h", "<i2"),
+    "I": ("I", "<u4"),
+    "i": ("i", "<i4"),
+}
+
+
+class DatalogStore:
+    """
+    Local append-only columnar store of decoded datalogs.
+
+    Every day has its own partition directory per schema (the datalabels and their datatypes),
+    containing the schema, a timestamp column (milliseconds since epoch) and one column of
+    unscaled values per datalabel. Each column is a file of fixed-width little-endian integers,
+    sized by the datatype of the datalabel, named by the position of the datalabel (f0.col,
+    f1.col, ...) as labels can repeat. Rows are buffered and appended to the columns every
+    `flush_rows` rows or `flush_interval` seconds.
+    """
+
+    def __init__(self, directory, flush_rows=60, flush_interval=60):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._day = None
+        self._decoder = None
+        self._partition = None
+        self._schema = None
+        self._columns = None
+        self._flushed = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, decoder, message, timestamp=None):
+        """
+        Append the message of a datalog response, decoded with `decoder`.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        raw = decoder.decode_raw(message)
+        if raw is None:
+            return
+        day = datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d")
+        if day != self._day or decoder is not self._decoder:
+            self.flush()
+            self._open_partition(day, decoder)
+        self._columns[0].append(int(timestamp * 1000))
+        for column, value in zip(self._columns[1:], raw):
+            column.append(value)
+        if (
+            len(self._columns[0]) >= self.flush_rows
+            or time.monotonic() - self._flushed >= self.flush_interval
+        ):
+            self.flush()
+
+    def _open_partition(self, day, decoder):
+        schema = {
+            "fields": [
+                {
+                    "label": f[2],
+                    "datatype": f[1],
+                    "dtype": column_types[code][1],
+                    "column": f"f{i}.col",
+                }
+                for i, (f, code) in enumerate(zip(decoder.fields, decoder.codes))
+            ],
+        }
+        digest = hashlib.sha1(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+        partition = os.path.join(self.directory, f"{day}_{digest[:12]}")
+        os.makedirs(partition, exist_ok=True)
+        schema_file = os.path.join(partition, "schema.json")
+        if not os.path.exists(schema_file):
+            with open(schema_file + ".tmp", "w") as f:
+                json.dump(schema, f)
+            os.replace(schema_file + ".tmp", schema_file)
+        self._day = day
+        self._decoder = decoder
+        self._partition = partition
+        self._schema = schema
+        self._columns = [array.array("q")] + [
+            array.array(column_types[code][0]) for code in decoder.codes
+        ]
+
+    def flush(self):
+        self._flushed = time.monotonic()
+        if self._columns is None or len(self._columns[0]) == 0:
+            return
+        names = ["timestamp.col"] + [f["column"] for f in self._schema["fields"]]
+        for name, column in zip(names, self._columns):
+            if sys.byteorder == "big":
+                column.byteswap()
+            with open(os.path.join(self._partition, name), "ab") as f:
+                column.tofile(f)
+            del column[:]
+
+    def close(self):
+        self.flush()
+
+
+def list_partitions(directory):
+    partitions = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.exists(os.path.join(path, "schema.json")):
+            day = datetime.datetime.strptime(name.split("_")[0], "%Y-%m-%d")
+            partitions.append((day.replace(tzinfo=datetime.timezone.utc), path))
+    return partitions
+
+
+def apply_retention(directory, days):
+    """
+    Remove partitions older than `days` days.
+    """
+    today = datetime.datetime.now(datetime.timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    cutoff = today - datetime.timedelta(days=days)
+    for day, path in list_partitions(directory):
+        if day < cutoff:
+            logger.info(f"Removing {path}")
+            shutil.rmtree(path)
+
+
+def read_column(np, path, name, dtype):
+    """
+    Read a column file, a column that wasn't written yet is empty.
+    """
+    try:
+        return np.fromfile(os.path.join(path, name), dtype=dtype)
+    except FileNotFoundError:
+        return np.array([], dtype=dtype)
+
+
+def read_partition(np, path, labels, start_ms, end_ms):
+    """
+    Read the rows between start_ms and end_ms of a partition. Returns the timestamps (ms)
+    and a dict of label: scaled values. Labels that are not in the partition are NaN, of a
+    label that repeats the first datalabel is read.
+    """
+    from itho_decode import scale_array
+
+    with open(os.path.join(path, "schema.json")) as f:
+        fields = {}
+        for field in json.load(f)["fields"]:
+            fields.setdefault(field["label"], field)
+
+    timestamps = read_column(np, path, "timestamp.col", "<i8")
+    columns = {}
+    rows = len(timestamps)
+    for label in labels:
+        if label not in fields:
+            continue
+        # Partitions written before columns were named by position use the label
+        name = fields[label].get("column", f"{label}.col")
+        columns[label] = read_column(np, path, name, fields[label]["dtype"])
+        # An interrupted flush can leave columns of different lengths
+        rows = min(rows, len(columns[label]))
+
+    timestamps = timestamps[:rows]
+    selected = (timestamps >= start_ms) & (timestamps < end_ms)
+    values = {}
+    for label in labels:
+        if label in columns:
+            raw = columns[label][:rows][selected]
+            values[label] = scale_array(np, raw, fields[label]["datatype"]).astype(np.float64)
+        else:
+            values[label] = np.full(np.count_nonzero(selected), np.nan)
+    return timestamps[selected], values
+
+
+def query(directory, labels, start, end, bucket=None):
+    """
+    Return the timestamps (ms) and values of `labels` between the datetimes `start` and `end`.
+    With `bucket` (seconds) the values are downsampled to the minimum, maximum and average per
+    bucket, as a dict of label: (min, max, avg).
+    """
+    import numpy as np
+
+    start_ms = int(start.timestamp() * 1000)
+    end_ms = int(end.timestamp() * 1000)
+    first_day = start.astimezone(datetime.timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    parts = [
+        read_partition(np, path, labels, start_ms, end_ms)
+        for day, path in list_partitions(directory)
+        if first_day <= day < end
+    ]
+    if not parts:
+        return np.array([], dtype=np.int64), {label: np.array([]) for label in labels}
+
+    order = np.argsort(np.concatenate([p[0] for p in parts]), kind="stable")
+    timestamps = np.concatenate([p[0] for p in parts])[order]
+    values = {label: np.concatenate([p[1][label] for p in parts])[order] for label in labels}
+    if bucket is None or len(timestamps) == 0:
+        return timestamps, values
+
+    buckets = (timestamps - start_ms) // int(bucket * 1000)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    counts = np.diff(np.r_[starts, len(timestamps)])
+    bucket_timestamps = start_ms + buckets[starts] * int(bucket * 1000)
+    downsampled = {}
+    for label, v in values.items():
+        valid = ~np.isnan(v)
+        filled = np.where(valid, v, 0)
+        n = np.add.reduceat(valid, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            downsampled[label] = (
+                np.fmin.reduceat(np.where(valid, v, np.inf), starts),
+                np.fmax.reduceat(np.where(valid, v, -np.inf), starts),
+                np.add.reduceat(filled, starts) / n,
+            )
+        empty = n == 0
+        for a in downsampled[label][0:2]:
+            a[empty] = np.nan
+    logger.debug(f"Downsampled {len(timestamps)} rows to {len(counts)} buckets")
+    return bucket_timestamps, downsampled
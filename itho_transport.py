@@ -0,0 +1,178 @@
+import collections
+import heapq
+import json
+import logging
+import sys
+import threading
+import time
+from itho_i2c import get_response_key
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stdout_log_handler = logging.StreamHandler(sys.stdout)
+stdout_log_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(stdout_log_handler)
+
+
+class RecordingTransport:
+    """
+    Wrap a transport (e.g. itho_i2c.I2CBus) and record every request and every valid response
+    with its time to a file, one JSON object per line:
+
+        {"time": 0.0, "request": "80a4010400d6"}
+        {"time": 0.0213, "response": "82a40101..."}
+
+    Times are in seconds since the transport was opened. A recording can be played back with
+    ReplayTransport.
+    """
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._started = None
+        self._queue = None
+
+    def _record(self, direction, frame):
+        line = json.dumps({"time": round(time.monotonic() - self._started, 6), direction: frame})
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def open(self, queue):
+        if self._file is None:
+            self._file = open(self.path, "a")
+            self._started = time.monotonic()
+        self._queue = queue
+        self.transport.open(self)
+
+    def put(self, item, block=True, timeout=None):
+        # Called by the transport for every response, the response is passed on to the queue
+        self._record("response", bytes(item).hex())
+        self._queue.put(item, block, timeout)
+
+    @property
+    def rejected(self):
+        return getattr(self.transport, "rejected", 0)
+
+    def write_i2c_block_data(self, data):
+        self._record("request", bytes(data).hex())
+        return self.transport.write_i2c_block_data(data)
+
+    def close(self):
+        self.transport.close()
+        if self._file is not None:
+            self._file.flush()
+
+
+def read_recording(path):
+    """
+    Read a recording of RecordingTransport. Returns a dict of request: list of exchanges,
+    where an exchange is a list of (delay after the request, response) tuples.
+
+    A response belongs to the last request before it with the same message class and
+    identifier (see itho_i2c.get_response_key), so responses to pipelined requests are kept
+    with their own request. Responses without a request are dropped.
+    """
+    exchanges = collections.defaultdict(list)
+    outstanding = {}  # response key: (time sent, responses)
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if "request" in entry:
+                request = bytes.fromhex(entry["request"])
+                responses = []
+                exchanges[request].append(responses)
+                outstanding[get_response_key(request)] = (entry["time"], responses)
+                continue
+            response = bytes.fromhex(entry["response"])
+            exchange = outstanding.get(get_response_key(response))
+            if exchange is None:
+                logger.debug(f"Dropping response without request: {response.hex(' ')}")
+                continue
+            sent, responses = exchange
+            responses.append((max(0, entry["time"] - sent), response))
+    return dict(exchanges)
+
+
+class DelayedDelivery:
+    """
+    Put responses on a queue after a delay, from a background thread.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._pending = []  # heap of (time due, sequence number, response)
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def open(self, queue):
+        self._queue = queue
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="delivery", daemon=True)
+            self._thread.start()
+
+    def put(self, response, delay):
+        if delay <= 0:
+            self._queue.put(response)
+            return
+        with self._condition:
+            heapq.heappush(self._pending, (time.monotonic() + delay, self._sequence, response))
+            self._sequence += 1
+            self._condition.notify()
+
+    def _run(self):
+        with self._condition:
+            while self._thread is threading.current_thread():
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                wait = self._pending[0][0] - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                self._queue.put(heapq.heappop(self._pending)[2])
+
+    def close(self):
+        with self._condition:
+            self._thread = None
+            self._pending = []
+            self._condition.notify()
+
+
+class ReplayTransport:
+    """
+    Play back a recording of RecordingTransport instead of using the I2C bus.
+
+    Each request is answered with the responses that followed the same request in the
+    recording, after the recorded delay divided by `speed`. With `speed` 0 the responses are
+    returned immediately. When a request was recorded several times, the recorded exchanges
+    are played back in order and then repeated, so a recording of a few polls can be replayed
+    by a daemon indefinitely. A request that was never recorded gets no response.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.exchanges = read_recording(path)
+        self._positions = collections.Counter()
+        self._delivery = DelayedDelivery()
+
+    def open(self, queue):
+        self._delivery.open(queue)
+
+    def write_i2c_block_data(self, data):
+        request = bytes(data)
+        exchanges = self.exchanges.get(request)
+        if not exchanges:
+            logger.debug(f"No recorded response to request: {request.hex(' ')}")
+            return 0
+        responses = exchanges[self._positions[request] % len(exchanges)]
+        self._positions[request] += 1
+        for delay, response in responses:
+            self._delivery.put(response, delay / self.speed if self.speed else 0)
+        return 0
+
+    def close(self):
+        self._delivery.close()
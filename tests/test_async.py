@@ -0,0 +1,36 @@
+import asyncio
+import time
+from itho_async import AsyncIthoWPU
+
+
+class SlowTransport:
+    """
+    Transport of which `open` blocks, like I2CBus.open while another client holds the bus.
+    """
+
+    def open(self, queue):
+        time.sleep(0.3)
+
+    def close(self):
+        pass
+
+
+def test_open_doesnt_block_event_loop():
+    async def main():
+        wpu = AsyncIthoWPU(SlowTransport())
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        await asyncio.gather(wpu.open(), wpu.open())
+        ticker.cancel()
+        assert wpu.is_open
+        await wpu.close()
+        return ticks
+
+    assert asyncio.run(main()) >= 10
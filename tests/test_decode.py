@@ -0,0 +1,16 @@
+from itho_decode import DatalogDecoder
+
+
+def test_decode_values_with_repeated_labels():
+    # (index, datatype, label, description), two fields share the label "temp"
+    decoder = DatalogDecoder(
+        [(0, 0x10, "temp", "Temp A"), (2, 0x10, "temp", "Temp B"), (4, 0x0, "pump", "Pump")]
+    )
+    message = bytes([0x00, 0x01, 0x00, 0x02, 0x03])
+    assert decoder.decode_values(message) == [1, 2, 3]
+    assert decoder.decode(message) == {"temp": 2, "pump": 3}
+
+
+def test_decode_values_too_short():
+    decoder = DatalogDecoder([(0, 0x10, "temp", "Temp")])
+    assert decoder.decode_values(bytes([0x00])) is None
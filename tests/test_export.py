@@ -0,0 +1,81 @@
+import threading
+import time
+from itho_export import DeadbandFilter, InfluxDBExporter
+
+
+class FakeClient:
+    """
+    Stands in for influxdb.InfluxDBClient, failing the first `failures` writes.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+        self.written = threading.Event()
+
+    def write_points(self, points):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("InfluxDB is unreachable")
+        self.batches.append(list(points))
+        self.written.set()
+
+
+def export(exporter, n):
+    for i in range(n):
+        exporter.export("getdatalog", {"value": i})
+
+
+def test_batch_size():
+    client = FakeClient()
+    exporter = InfluxDBExporter(client, batch_size=3, max_age=60)
+    exporter.start()
+    export(exporter, 3)
+    assert client.written.wait(5)
+    exporter.close()
+    assert [len(batch) for batch in client.batches] == [3]
+
+
+def test_max_age():
+    client = FakeClient()
+    exporter = InfluxDBExporter(client, batch_size=100, max_age=0.2)
+    exporter.start()
+    started = time.monotonic()
+    export(exporter, 2)
+    assert client.written.wait(5)
+    assert time.monotonic() - started >= 0.2
+    exporter.close()
+    assert [len(batch) for batch in client.batches] == [2]
+
+
+def test_full_buffer_drops_oldest():
+    client = FakeClient()
+    exporter = InfluxDBExporter(client, batch_size=10, max_age=60, max_buffer=3)
+    export(exporter, 5)
+    assert exporter.dropped == 2
+    exporter.start()
+    exporter.close()
+    values = [point["fields"]["value"] for batch in client.batches for point in batch]
+    assert values == [2, 3, 4]
+
+
+def test_retry_after_failed_write():
+    client = FakeClient(failures=1)
+    exporter = InfluxDBExporter(client, batch_size=2, max_age=60)
+    exporter.start()
+    export(exporter, 2)
+    assert client.written.wait(5)
+    exporter.close()
+    assert exporter.failed_flushes == 1
+    assert exporter.written == 2
+    assert [len(batch) for batch in client.batches] == [2]
+
+
+def test_deadband_per_action():
+    deadband = DeadbandFilter({"getcounters:hours": {"deadband": 10}}, heartbeat=300)
+    assert deadband.filter("getdatalog", {"hours": 1}, now=0) == {"hours": 1}
+    assert deadband.filter("getcounters", {"hours": 5}, now=0) == {"hours": 5}
+    # The counter doesn't suppress the datalabel with the same name, or the other way around
+    assert deadband.filter("getdatalog", {"hours": 2}, now=1) == {"hours": 2}
+    assert deadband.filter("getcounters", {"hours": 6}, now=1) == {}
+    assert deadband.filter("getcounters", {"hours": 15}, now=2) == {"hours": 15}
@@ -0,0 +1,35 @@
+import datetime
+from itho_decode import DatalogDecoder
+from itho_store import DatalogStore, query
+
+start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+end = start + datetime.timedelta(days=1)
+
+
+def make_decoder():
+    # "timestamp" and a repeated label must not share a column file
+    return DatalogDecoder(
+        [(0, 0x10, "timestamp", "Timestamp"), (2, 0x10, "temp", "Temp A"), (4, 0x0, "temp", "B")]
+    )
+
+
+def test_append_and_query(tmp_path):
+    store = DatalogStore(str(tmp_path), flush_rows=1)
+    for i in range(3):
+        message = bytes([0x00, i, 0x00, 10 + i, 20 + i])
+        store.append(make_decoder(), message, start.timestamp() + i)
+    store.close()
+    timestamps, values = query(str(tmp_path), ["timestamp", "temp"], start, end)
+    assert list(timestamps) == [int(start.timestamp() * 1000) + i * 1000 for i in range(3)]
+    assert list(values["timestamp"]) == [0, 1, 2]
+    assert list(values["temp"]) == [10, 11, 12]
+
+
+def test_query_before_first_flush(tmp_path):
+    store = DatalogStore(str(tmp_path), flush_rows=10)
+    store.append(make_decoder(), bytes([0, 0, 0, 10, 20]), start.timestamp())
+    # The schema is written, the columns aren't yet
+    timestamps, values = query(str(tmp_path), ["temp"], start, end)
+    assert len(timestamps) == 0
+    assert len(values["temp"]) == 0
+    store.close()